@@ -0,0 +1,131 @@
+"""A local stand-in for the MicroStrategy TaskProc.aspx endpoint, serving
+synthetic login, reportExecute, folderBrowse, browseElements and logout
+responses of configurable size.
+
+Usage: python benchmarks/mock_server.py [port]
+"""
+import BaseHTTPServer
+import SocketServer
+import os
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from parse_report import report_response
+
+
+class MockTaskProc(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded http server answering TaskProc requests.
+
+    Responses are generated once for each distinct request and then
+    served from memory, so that the cost of building them is not measured.
+
+    Args:
+        port (int): port to listen on, a free port if 0
+        rows (int): number of rows of the report
+        columns (int): number of columns of the report
+        folders (int): number of objects in each folder
+        elements (int): number of elements of each attribute
+        latency (float): seconds to wait before answering each request
+        gzip (bool): if True, responses are gzipped for the clients which
+            accept it
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, rows=1000, columns=20, folders=100,
+            elements=10000, latency=0, gzip=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+            TaskProcHandler)
+        self.rows = rows
+        self.columns = columns
+        self.folders = folders
+        self.elements = elements
+        self.latency = latency
+        self.gzip = gzip
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/MicroStrategy/asp/TaskProc.aspx?' % \
+            self.server_address[1]
+
+    def response(self, params, gzip=False):
+        task = params.get('taskId', params.get('taskID'))
+        key = (task, params.get('startRow'), params.get('maxRows'),
+            params.get('blockBegin'), params.get('blockCount'), gzip)
+        with self._lock:
+            body = self._responses.get(key)
+        if body is None:
+            body = self._build(task, params)
+            if gzip:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                body = compressor.compress(body) + compressor.flush()
+            with self._lock:
+                self._responses[key] = body
+        return body
+
+    def _build(self, task, params):
+        if task == 'login':
+            return ("<response><root><sessionState>session</sessionState>" +
+                "<name>mock</name></root></response>")
+        if task == 'reportExecute':
+            start = int(params.get('startRow', 0))
+            count = int(params.get('maxRows', self.rows))
+            count = max(min(count, self.rows - start), 0)
+            return report_response(count, self.columns, start)
+        if task == 'folderBrowse':
+            return "<response><folders>%s</folders></response>" % ''.join([
+                ("<obj><n>object %s</n><d>description %s</d><id>id%s</id>" +
+                "<t>%s</t></obj>") % (i, i, i, 3 if i % 4 else 8)
+                for i in range(self.folders)])
+        if task == 'browseElements':
+            begin = int(params.get('blockBegin', 1))
+            count = int(params.get('blockCount', self.elements))
+            end = min(begin + count, self.elements + 1)
+            return ("<response><elements>%s</elements><totalSize>%s" +
+                "</totalSize></response>") % (''.join(
+                ["<block><n>element %s</n></block>" % i
+                for i in range(begin, end)]), self.elements)
+        return "<response/>"
+
+
+class TaskProcHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed acks
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        params = dict(urlparse.parse_qsl(query))
+        gzip = self.server.gzip and \
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        body = self.server.response(params, gzip)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = MockTaskProc(port)
+    print "serving %s" % server.url
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
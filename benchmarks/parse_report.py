@@ -0,0 +1,95 @@
+"""Compares the time taken to parse a wide reportExecute response with the
+PyQuery based parser py-mstr used to ship and with the current one.
+
+Usage: python benchmarks/parse_report.py [rows] [columns]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyquery import PyQuery as pq
+from py_mstr import Attribute, Metric, Report
+from py_mstr.py_mstr import _ReportDefinition
+
+
+def report_response(rows, columns, first_row=0):
+    """Builds a ReportDataVisualizationXMLStyle response with the given
+    number of rows and columns, half attributes and half metrics. The
+    values of the rows start at first_row, as for a page of a larger report.
+    """
+    objects = []
+    headers = []
+    for col in range(columns):
+        tag = 'attribute' if col % 2 == 0 else 'metric'
+        objects.append("<%s rfd='%s' id='id%s' name='column %s'/>" % (tag, col,
+            col, col))
+        headers.append("<oi rfd='%s'/>" % col)
+    body = []
+    for row in range(first_row, first_row + rows):
+        body.append('<r>' + ''.join(['<v>%s</v>' % (row * col)
+            for col in range(columns)]) + '</r>')
+    return ("<response><report_data_list><report_data><objects>%s</objects>" +
+        "<raw_data><headers>%s</headers><rows>%s</rows></raw_data>" +
+        "</report_data></report_data_list></response>") % (''.join(objects),
+        ''.join(headers), ''.join(body))
+
+
+def legacy_parse(response):
+    """The PyQuery parser, running one css query per header column.
+    """
+    d = pq(response)
+    if d('error'):
+        raise Exception(d('error')[0].text)
+    headers = []
+    obj = d('objects')
+    for col in d('headers').children():
+        elem = obj("[rfd='" + col.attrib['rfd'] + "']")
+        if elem('attribute'):
+            headers.append(Attribute(elem.attr('id'), elem.attr('name')))
+        else:
+            headers.append(Metric(elem.attr('id'), elem.attr('name')))
+    return [[(headers[index], val.text) for index, val
+            in enumerate(row.iterchildren())] for row in d('r')]
+
+
+class OfflineClient(object):
+    """Stands in for a logged in MstrClient, only parsing is measured.
+    """
+    _session = None
+
+    def _definition(self, report_id):
+        return _ReportDefinition()
+
+
+def current_parse(response):
+    report = Report(OfflineClient(), 'report_id')
+    return report._parse_report(response).get_values()
+
+
+def best_of(func, response, repeat=3):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func(response)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    columns = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    response = report_response(rows, columns)
+    assert legacy_parse(response) == current_parse(response)
+    legacy = best_of(legacy_parse, response)
+    current = best_of(current_parse, response)
+    print "%s rows x %s columns (%.1f MB)" % (rows, columns,
+        len(response) / 1e6)
+    print "pyquery: %.3fs" % legacy
+    print "lxml:    %.3fs" % current
+    print "speedup: %.1fx" % (legacy / current)
+
+
+if __name__ == '__main__':
+    main()
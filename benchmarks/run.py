@@ -0,0 +1,187 @@
+"""Measures py-mstr against a local mock TaskProc server, see mock_server.py.
+
+Each benchmark runs in its own process, so that its peak memory is not
+hidden by the previous ones, and reports the throughput, the peak
+resident memory and the latency percentiles of its calls. Items are the
+rows, folder objects or elements returned. MB/s counts the responses once
+decompressed, wire MB/s as they were sent by the server, which differ with
+--gzip.
+
+Usage: python benchmarks/run.py [options] [benchmark ...]
+
+Run with --help for the options. All benchmarks are run if none is named.
+"""
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from mock_server import MockTaskProc
+from py_mstr import MetricsCollector, MstrClient
+
+
+def execute(client, options):
+    return len(client.get_report('report_id').execute(max_rows=options.rows))
+
+
+def execute_paged(client, options):
+    return len(client.get_report('report_id').execute_paged(
+        page_size=max(options.rows / 4, 1)))
+
+
+def iter_rows(client, options):
+    rows = 0
+    for row in client.get_report('report_id').iter_rows(max_rows=options.rows):
+        rows += 1
+    return rows
+
+
+def to_columns(client, options):
+    return len(client.get_report('report_id').to_columns(
+        max_rows=options.rows))
+
+
+def typed_execute(client, options):
+    return len(client.get_report('report_id').execute(max_rows=options.rows,
+        typed=True))
+
+
+def folders(client, options):
+    return len(client.get_folder_contents('folder_id'))
+
+
+def elements(client, options):
+    return len(client.list_elements('attribute_id',
+        block_size=max(options.elements / 4, 1)))
+
+
+BENCHMARKS = [execute, execute_paged, iter_rows, to_columns, typed_execute,
+    folders, elements]
+
+
+def percentile(values, percent):
+    """Returns the percentile (0-100) of the sorted values, by the nearest
+    rank method.
+    """
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def measure(benchmark, url, options, queue):
+    """Runs a benchmark in the current process and puts its results on the
+    queue.
+    """
+    metrics = MetricsCollector()
+    client = MstrClient(url, 'user', 'password', 'source', 'project',
+        pool_maxsize=options.concurrency, hooks=[metrics])
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def call(i):
+        start = time.time()
+        rows = benchmark(client, options)
+        return time.time() - start, rows
+
+    pool = ThreadPool(options.concurrency)
+    start = time.time()
+    calls = pool.map(call, range(options.repeat))
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    received = compressed = 0
+    for task in ('reportExecute', 'folderBrowse', 'browseElements'):
+        histogram = metrics.histogram(task, 'bytes_received')
+        if histogram:
+            received += histogram.total
+        histogram = metrics.histogram(task, 'bytes_compressed')
+        if histogram:
+            compressed += histogram.total
+    queue.put({
+        'latencies': sorted([latency for latency, rows in calls]),
+        'rows': sum([rows for latency, rows in calls]),
+        'elapsed': elapsed,
+        'bytes': received,
+        'wire_bytes': compressed,
+        'base_memory': base_memory,
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+
+def run(benchmark, url, options):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(benchmark, url,
+        options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def serve(options, ready):
+    server = MockTaskProc(rows=options.rows, columns=options.columns,
+        folders=options.folders, elements=options.elements,
+        latency=options.latency, gzip=options.gzip)
+    ready.put(server.url)
+    server.serve_forever()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option('--rows', type='int', default=10000,
+        help="rows of the report [%default]")
+    parser.add_option('--columns', type='int', default=20,
+        help="columns of the report [%default]")
+    parser.add_option('--folders', type='int', default=500,
+        help="objects in each folder [%default]")
+    parser.add_option('--elements', type='int', default=20000,
+        help="elements of each attribute [%default]")
+    parser.add_option('--latency', type='float', default=0,
+        help="seconds added by the server to each request [%default]")
+    parser.add_option('--gzip', action='store_true', default=False,
+        help="gzip the responses of the server")
+    parser.add_option('--repeat', type='int', default=10,
+        help="calls made by each benchmark [%default]")
+    parser.add_option('--concurrency', type='int', default=1,
+        help="calls made at once [%default]")
+    options, names = parser.parse_args()
+    benchmarks = [b for b in BENCHMARKS if not names or b.__name__ in names]
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, ready))
+    server.daemon = True
+    server.start()
+    url = ready.get()
+
+    print "%-14s %8s %10s %7s %7s %8s %8s %8s %8s %8s" % ('benchmark',
+        'calls/s', 'items/s', 'MB/s', 'wire', 'peak MB', 'grew MB', 'p50 ms',
+        'p95 ms', 'p99 ms')
+    try:
+        for benchmark in benchmarks:
+            result = run(benchmark, url, options)
+            elapsed = result['elapsed']
+            latencies = result['latencies']
+            print ("%-14s %8.1f %10.0f %7.1f %7.1f %8.1f %8.1f %8.1f %8.1f " +
+                "%8.1f") % (
+                benchmark.__name__, len(latencies) / elapsed,
+                result['rows'] / elapsed, result['bytes'] / 1e6 / elapsed,
+                result['wire_bytes'] / 1e6 / elapsed,
+                # ru_maxrss is in kilobytes on Linux
+                result['peak_memory'] / 1024.0,
+                (result['peak_memory'] - result['base_memory']) / 1024.0,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
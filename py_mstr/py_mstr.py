@@ -1,38 +1,190 @@
+import bisect
+import csv
+import hashlib
+import io
+import itertools
+import json
 import urllib
 import requests
 import logging
-
+import random
+import sqlite3
+import zlib
+import threading
+import time
+import weakref
+# strptime is not thread safe the first time it is called
+import _strptime
+
+from array import array
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from lxml import etree
+from multiprocessing.pool import ThreadPool
 from pyquery import PyQuery as pq
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 """ This API only supports xml format, as it relies on the format for parsing
     the data into python data structures
 """
 BASE_PARAMS = {'taskEnv': 'xml', 'taskContentType': 'xml'}
 BASE_URL = 'http://hostname/MicroStrategy/asp/TaskProc.aspx?'
+""" Number of characters of the response bodies logged at debug level
+"""
+MAX_LOGGED_BODY = 2000
+""" Error codes returned by the Task Service when the session has expired
+    or is no longer valid
+"""
+SESSION_ERROR_CODES = ('-2147468986',)
+""" Failure messages, in lower case, returned by the Task Service without an
+    error code when the session has expired
+"""
+SESSION_ERROR_MESSAGES = ("the user's session has expired, please "
+    "reauthenticate", 'session expired')
+""" Column types of the attribute forms, indexed on their base_form_type
+    (EnumDSSXMLBaseFormType). Forms of other types are text.
+"""
+FORM_TYPES = {'1': 'datetime', '2': 'number', '8': 'date', '9': 'time',
+    '11': 'decimal'}
+DATETIME_FORMATS = ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d')
+TIME_FORMATS = ('%I:%M:%S %p', '%H:%M:%S')
 logger = logging.getLogger(__name__)
 
 class MstrClient(object):
     """Class encapsulating base logic for the MicroStrategy Task Proc API
+
+    A client may be shared by several threads: requests go through a
+    thread safe connection pool and do not modify their arguments.
     """
     def __init__(self, base_url, username, password, project_source,
-            project_name):
+            project_name, pool_connections=10, pool_maxsize=10, max_retries=0,
+            timeout=None, task_timeouts=None, session_pool=None, cache=None,
+            cache_ttls=None, result_cache=None, hooks=None, retry_policy=None,
+            circuit_breaker=None, max_url_length=2048, compress_requests=False,
+            parse_pool=None):
         """Initialize the MstrClient by logging in and retrieving a session.
 
+        All requests made by the client go through a single keep-alive
+        http session, so connections to the server are reused across tasks.
+
         Args:
             base_url (str): base url of form http://hostname/MicroStrategy/asp/TaskProc.aspx?
             username (str): username for project
             password (str): password for project
             project_source (str): project source of form ip-####
             project_name (str): name of project
+            pool_connections (int): number of connection pools to cache
+            pool_maxsize (int): maximum number of connections kept alive
+                per pool. Should be at least the number of threads sharing
+                this client
+            max_retries (int): number of retries on failed connections
+            timeout (float): default timeout in seconds for requests
+            task_timeouts (dict): maps a task id (e.g. 'reportExecute') to
+                the timeout in seconds to use for that task instead of
+                the default
+            session_pool (MstrSessionPool): if supplied, the session is
+                taken from the pool rather than by logging in, and handed
+                back to it rather than logged out
+            cache (MemoryCache/SqliteCache): if supplied, the results of
+                get_folder_contents, get_attribute and list_elements are
+                stored in the cache and reused until they expire
+            cache_ttls (dict): maps one of the cached method names to the
+                number of seconds its results are kept, overriding the
+                default ttl of the cache
+            result_cache (MemoryCache/SqliteCache): if supplied, the rows
+                retrieved by executing reports are stored in the cache, and
+                executing a report again with the same rows, columns and
+                prompt answers reuses them until they expire. A MemoryCache
+                only bounds the number of results kept, whatever their
+                size; use a SqliteCache with max_bytes to bound their size
+            hooks (list): RequestHooks objects, e.g. a MetricsCollector,
+                notified of every request made by the client
+            retry_policy (RetryPolicy): if supplied, failed requests are
+                retried according to the policy
+            circuit_breaker (CircuitBreaker): if supplied, requests fail
+                immediately while the breaker is open
+            max_url_length (int): requests whose url would be longer, e.g.
+                with many prompt answers, are sent as a POST with the
+                parameters in the body. IIS rejects query strings longer
+                than 2048 characters by default
+            compress_requests (bool): if True, the bodies of POST requests
+                are gzip compressed. The web server must be configured to
+                accept compressed requests
+            parse_pool (multiprocessing.Pool): if supplied, the responses
+                of to_columns are parsed in the worker processes of the
+                pool, so that threads sharing the client parse reports on
+                several cores at once. The pool is not closed by the client
+
+        Requests whose session has expired are retried once with a new
+        session, the client logging in again with its credentials.
         """
         self._base_url = base_url
-        self._session = self._login(project_source, project_name,
+        self._timeout = timeout
+        self._task_timeouts = task_timeouts or {}
+        # per thread settings, e.g. the timeout of the job being executed
+        self._local = threading.local()
+        self._hooks = list(hooks or [])
+        self._retry_policy = retry_policy
+        self._max_url_length = max_url_length
+        self._compress_requests = compress_requests
+        self._parse_pool = parse_pool
+        self._circuit_breaker = circuit_breaker
+        self._credentials = (project_source, project_name, username, password)
+        self._login_lock = threading.Lock()
+        self._http = requests.Session()
+        # responses are decompressed while they are read, see _send
+        self._http.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            max_retries=max_retries)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        self._cache = cache
+        self._cache_ttls = cache_ttls or {}
+        self._result_cache = result_cache
+        # report definitions shared by the Report objects, by report guid
+        self._definitions = {}
+        self._definitions_lock = threading.Lock()
+        self._cache_prefix = '|'.join([base_url, project_source, project_name,
+            username])
+        self._session_pool = session_pool
+        if session_pool:
+            self._session = session_pool.acquire(self, project_source,
+                project_name, username, password)
+        else:
+            self._session = self._login(project_source, project_name,
                 username, password)
 
     def __del__(self):
-        """Logs the user out of the session.
+        """Logs the user out of the session, or returns it to the session
+        pool, and closes the connections.
         """
-        self._logout()
+        if not (self._session_pool and
+                self._session_pool.release(self._session)):
+            self._logout()
+        self._http.close()
 
     def __str__(self):
         return 'MstrClient session: %s' % self._session
@@ -58,6 +210,108 @@ class MstrClient(object):
         """
         return Report(self, report_id)
 
+    def clear_report_definitions(self, report_id=None):
+        """Forgets the prompts, headers and attributes of a report, or of
+        all the reports if report_id is None, so that they are retrieved
+        from the server again, e.g. after the report has been modified.
+
+        Args:
+            report_id (str): report guid for the report
+        """
+        with self._definitions_lock:
+            if report_id is None:
+                self._definitions.clear()
+            else:
+                self._definitions.pop(report_id, None)
+
+    def _definition(self, report_id):
+        """Returns the _ReportDefinition of a report, shared by all the
+        Report objects of this client with the same guid.
+        """
+        with self._definitions_lock:
+            definition = self._definitions.get(report_id)
+            if definition is None:
+                definition = self._definitions[report_id] = \
+                    _ReportDefinition()
+            return definition
+
+    def execute_many(self, jobs, max_workers=4, per_job_timeout=None,
+            retries=0):
+        """Executes many reports concurrently, yielding the results as the
+        executions complete.
+
+        Jobs are started in order of priority, lower values first, and at
+        most max_workers reports are executed at once, which bounds the
+        load put on the server. A failed job does not stop the others: its
+        exception is stored on the JobResult instead of being raised.
+
+        Args:
+            jobs (list): dictionaries with the 'report_id' of the report to
+                execute, an optional 'priority' (0 if not supplied), and
+                any other keyword arguments of Report.execute, e.g.
+                {'report_id': guid, 'priority': 1, 'max_rows': 1000}
+            max_workers (int): maximum number of reports executed at once.
+                The client should be created with a pool_maxsize of at
+                least that many connections
+            per_job_timeout (float): maximum number of seconds taken by
+                each job, including its retries. The timeout of each of
+                its requests is shortened to the time left, and a job out
+                of time fails with a Timeout. A request already waiting on
+                the server is only interrupted by its own timeout
+            retries (int): number of times a job is retried after a
+                connection error, a timeout or a retriable error status
+
+        Yields:
+            JobResult: the outcome and timing of each job
+        """
+
+        def execute(job):
+            return self._execute_job(job, per_job_timeout, retries)
+
+        jobs = sorted(jobs, key=lambda job: job.get('priority', 0))
+        pool = ThreadPool(max_workers)
+        completed = False
+        try:
+            for job_result in pool.imap_unordered(execute, jobs):
+                yield job_result
+            completed = True
+        finally:
+            # stopped early: the queued jobs are dropped, the reports being
+            # executed are waited for
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def _execute_job(self, job, timeout, retries):
+        kwargs = dict(job)
+        report = self.get_report(kwargs.pop('report_id'))
+        kwargs.pop('priority', None)
+        result = error = None
+        attempts = 0
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        self._local.deadline = deadline
+        try:
+            while True:
+                attempts += 1
+                try:
+                    result = report.execute(**kwargs)
+                    break
+                except Exception as e:
+                    retriable = getattr(e, 'retriable', False) or \
+                        isinstance(e, requests.exceptions.RequestException)
+                    if not retriable or attempts > retries or \
+                            deadline is not None and time.time() >= deadline:
+                        error = e
+                        break
+                    logger.info("retrying report %s after error: %s" %
+                        (report._id, e))
+        finally:
+            self._local.deadline = None
+        return JobResult(job, result, error, attempts, time.time() - start)
+
     def get_folder_contents(self, folder_id=None):
         """Returns a dictionary with folder name, GUID, and description.
 
@@ -70,12 +324,75 @@ class MstrClient(object):
                 as keys 
         """
 
+        return self._cached('get_folder_contents', folder_id,
+            self._get_folder_contents, folder_id)
+
+    def _get_folder_contents(self, folder_id):
         arguments = {'sessionState': self._session, 'taskID': 'folderBrowse'}
         if folder_id:
             arguments.update({'folderID': folder_id})
         response = self._request(arguments)
         return self._parse_folder_contents(response)
 
+    def walk_folders(self, root_id=None, max_depth=None, concurrency=8,
+            types=None):
+        """Walks the folder tree below a folder, breadth first.
+
+        The folders of each level are browsed concurrently and objects are
+        yielded as soon as the folder holding them has been browsed, so
+        the order of objects within a level is not deterministic. Folders
+        already visited are not browsed again.
+
+        Args:
+            root_id (str): guid of the folder to start from. If not
+                supplied, starts from the root folder
+            max_depth (int): number of levels of folders to browse, 1
+                only browsing the starting folder. Unlimited if not supplied
+            concurrency (int): maximum number of folders browsed at once
+            types (list): object types to yield, e.g. [3, 8]. All objects
+                are yielded if not supplied
+
+        Yields:
+            tuple: a (path, obj) pair, where path is the tuple of folder
+                names leading from the starting folder to obj, and obj is
+                a dictionary as returned by get_folder_contents
+        """
+
+        def browse(folder):
+            path, folder_id = folder
+            return path, self.get_folder_contents(folder_id)
+
+        if types:
+            types = set([str(t) for t in types])
+        seen = set([root_id])
+        level = [((), root_id)]
+        depth = 0
+        pool = ThreadPool(concurrency)
+        completed = False
+        try:
+            while level and (max_depth is None or depth < max_depth):
+                next_level = []
+                for path, contents in pool.imap_unordered(browse, level):
+                    for obj in contents:
+                        if not types or obj['type'] in types:
+                            yield path, obj
+                        # type 8 is a folder
+                        if obj['type'] == '8' and obj['id'] not in seen:
+                            seen.add(obj['id'])
+                            next_level.append((path + (obj['name'],),
+                                obj['id']))
+                level = next_level
+                depth += 1
+            completed = True
+        finally:
+            # stopped early: the queued folders are dropped, the folders
+            # being browsed are waited for
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
     def _parse_folder_contents(self, response):
         d = pq(response)
         result = []
@@ -88,31 +405,142 @@ class MstrClient(object):
             })
         return result
 
-    def list_elements(self, attribute_id):
+    def list_elements(self, attribute_id, block_size=None, concurrency=4):
         """Returns the elements associated with the given attribute id.
         
         Note that if the call fails (i.e. MicroStrategy returns an
-        out of memory stack trace) the returned list is empty
+        out of memory stack trace) the returned list is empty. For
+        attributes with many elements, supply a block_size so that the
+        elements are retrieved in blocks, see iter_elements.
 
         Args:
             attribute_id (str): the attribute guid
+            block_size (int): number of elements retrieved with each
+                request. If not supplied, all elements are retrieved at once
+            concurrency (int): maximum number of blocks requested at once
 
         Returns:
             list: a list of strings containing the names for attribute values
         """
 
+        return self._cached('list_elements', attribute_id,
+            self._list_elements, attribute_id, block_size, concurrency)
+
+    def _list_elements(self, attribute_id, block_size, concurrency):
+        if block_size:
+            return list(self.iter_elements(attribute_id, block_size,
+                concurrency))
         arguments = {'taskId': 'browseElements', 'attributeID': attribute_id,
                 'sessionState': self._session}
         response = self._request(arguments)
-        return self._parse_elements(response)
-        
+        return self._parse_elements(response)[0]
+
+    def iter_elements(self, attribute_id, block_size=10000, concurrency=4):
+        """Yields the elements associated with the given attribute id,
+        retrieving them in blocks of block_size elements.
+
+        The first block gives the total number of elements, after which
+        the remaining blocks are requested concurrently, at most
+        concurrency blocks ahead of the caller. Elements are yielded in
+        order as soon as their block has been received. If the server does
+        not return the total, blocks are requested until one is short.
+        Closing the generator stops requesting blocks.
+
+        Args:
+            attribute_id (str): the attribute guid
+            block_size (int): number of elements retrieved with each request
+            concurrency (int): maximum number of blocks requested at once
+
+        Yields:
+            str: the name of each attribute value
+        """
+
+        def browse(block_begin):
+            arguments = {'taskId': 'browseElements',
+                'attributeID': attribute_id, 'sessionState': self._session,
+                'blockBegin': block_begin, 'blockCount': block_size}
+            return self._parse_elements(self._request(arguments))
+
+        # blocks are numbered from 1
+        elements, total, count = browse(1)
+        for element in elements:
+            yield element
+        if total is None:
+            if count < block_size:
+                return
+            # without a total, blocks are requested until one is short
+            begins = itertools.count(1 + block_size, block_size)
+        elif total <= block_size:
+            return
+        else:
+            begins = iter(range(1 + block_size, total + 1, block_size))
+        pool = ThreadPool(concurrency)
+        completed = False
+        try:
+            pending = [pool.apply_async(browse, (begin,))
+                for begin in itertools.islice(begins, concurrency)]
+            while pending:
+                elements, size, count = pending.pop(0).get()
+                last = total is None and count < block_size
+                if not last:
+                    begin = next(begins, None)
+                    if begin is not None:
+                        pending.append(pool.apply_async(browse, (begin,)))
+                for element in elements:
+                    yield element
+                if last:
+                    break
+            completed = True
+        finally:
+            # stopped early: the queued blocks are dropped, the requests
+            # in flight are waited for
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def list_elements_many(self, attribute_ids, block_size=None,
+            concurrency=4):
+        """Returns the elements of several attributes, listing up to
+        concurrency attributes at once.
+
+        Args:
+            attribute_ids (list): the attribute guids
+            block_size (int): see list_elements. The blocks of an attribute
+                are requested one after the other
+            concurrency (int): maximum number of attributes listed at once
+
+        Returns:
+            dict: maps each attribute guid to its list of element names
+        """
+
+        def browse(attribute_id):
+            return attribute_id, self.list_elements(attribute_id, block_size,
+                1)
+
+        pool = ThreadPool(concurrency)
+        try:
+            return dict(pool.map(browse, attribute_ids))
+        finally:
+            pool.close()
+            pool.join()
+
     def _parse_elements(self, response):
+        """Returns the element names, the total number of elements of the
+        attribute, which is None if the server did not report it, and the
+        number of elements of the block, including those without a name.
+        """
         d = pq(response)
+        blocks = d('block')
         result = []
-        for attr in d('block'):
+        for attr in blocks:
             if attr.find('n').text:
                 result.append(attr.find('n').text)
-        return result
+        total = d[0].find('.//totalSize') if d else None
+        if total is None or not total.text:
+            return result, None, len(blocks)
+        return result, int(total.text), len(blocks)
 
 
     def get_attribute(self, attribute_id):
@@ -130,36 +558,890 @@ class MstrClient(object):
 
         if not attribute_id:
             raise MstrClientException("You must provide an attribute id")
+        guid, name = self._cached('get_attribute', attribute_id,
+            self._get_attribute, attribute_id)
+        return Attribute(guid, name)
+
+    def _get_attribute(self, attribute_id):
         arguments = {'taskId': 'getAttributeForms', 'attributeID': attribute_id,
                 'sessionState': self._session}
         response = self._request(arguments)
         d = pq(response)
-        return Attribute(d('dssid')[0].text, d('n')[0].text)
+        return d('dssid')[0].text, d('n')[0].text
+
+    def _cached(self, method, key, func, *args):
+        """Returns the cached result of a metadata request, calling func
+        with args to retrieve it on a miss.
+        """
+        if self._cache is None:
+            return func(*args)
+        key = '%s|%s|%s' % (self._cache_prefix, method, key)
+        value = self._cache.get(key)
+        if value is None:
+            value = func(*args)
+            self._cache.set(key, value, self._cache_ttls.get(method))
+        return value
+
+    def invalidate_cache(self, method=None):
+        """Removes cached metadata from the cache of this client.
+
+        Args:
+            method (str): name of the method whose results are removed,
+                e.g. 'list_elements'. If not supplied, all the metadata
+                of this client's project is removed
+        """
+        if self._cache is None:
+            return
+        prefix = self._cache_prefix + '|'
+        if method:
+            prefix += method + '|'
+        self._cache.invalidate(prefix)
+
+    def _session_alive(self, session):
+        """Checks that the server still accepts a session, by browsing the
+        root folder with it.
+        """
+        arguments = {'sessionState': session, 'taskID': 'folderBrowse'}
+        try:
+            # the client has no session to renew yet
+            d = pq(self._request(arguments, relogin=False))
+        except MstrRequestException as e:
+            logger.info("session check failed: %s", e)
+            return False
+        return bool(d('folders')) and not d('error')
 
     def _logout(self):
         arguments = {'sessionState': self._session, 'taskId': 'logout'}
         arguments.update(BASE_PARAMS)
         result = self._request(arguments)
-        logging.info("logging out returned %s" % result)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("logging out returned %s", result[:MAX_LOGGED_BODY])
 
 
-    def _request(self, arguments):
+    def _request(self, arguments, stream=False, relogin=True):
         """Assembles the url and performs a get request to
         the MicroStrategy Task Service API
 
         Args:
             arguments (dict): Maps get key parameters to values
+            stream (bool): if True, the body is not downloaded up front
+                and a file-like object over the raw response is returned
+            relogin (bool): if False, an expired session raises an
+                MstrRequestException instead of being renewed
 
         Returns: 
-            str: the xml text response
+            str: the undecoded xml body of the response, or a file-like
+                object if stream is True. In the latter case the connection is returned to
+                the pool once the response has been read
         """
 
-        arguments.update(BASE_PARAMS)
-        request = self._base_url + urllib.urlencode(arguments)
-        logger.info("submitting request %s" % request)
-        response = requests.get(request)
-        logger.info("received response %s" % response.text)
-        return response.text
+        arguments = dict(arguments, **BASE_PARAMS)
+        task_id = arguments.get('taskId', arguments.get('taskID'))
+        policy = self._retry_policy
+        breaker = self._circuit_breaker
+        attempt = 0
+        relogged = False
+        deadline = getattr(self._local, 'deadline', None)
+        while True:
+            attempt += 1
+            if deadline is not None and time.time() >= deadline:
+                raise requests.exceptions.Timeout("%s not sent, the job ran "
+                    "out of time" % task_id)
+            if breaker:
+                breaker.before_request()
+            try:
+                body = self._send(arguments, task_id, stream)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, MstrRequestException) as e:
+                retriable = getattr(e, 'retriable', True)
+                if breaker:
+                    breaker.record(not retriable)
+                if getattr(e, 'session_expired', False) and relogin and \
+                        not relogged and arguments.get('sessionState') and \
+                        task_id != 'logout':
+                    relogged = True
+                    attempt -= 1
+                    arguments['sessionState'] = self._relogin(
+                        arguments['sessionState'])
+                    continue
+                if not retriable or policy is None or \
+                        attempt > policy.retries_for(task_id):
+                    raise
+                delay = policy.delay(attempt)
+                logger.info("retrying %s in %.2fs after error: %s", task_id,
+                    delay, e)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # any other error, e.g. raised by a hook, must still end a
+                # trial request of the breaker
+                if breaker:
+                    breaker.record(False)
+                raise
+            if breaker:
+                breaker.record(True)
+            break
+        return body
+
+    def _send(self, arguments, task_id, stream):
+        """Makes a single request, raising an MstrRequestException if the
+        server returns an error status.
+
+        Returns the body of the response as bytes, which the xml parsers
+        decode themselves, or a _CountingReader over it if stream is True.
+        """
+        query = urllib.urlencode(arguments)
+        timeout = self._task_timeouts.get(task_id, self._timeout)
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None:
+            # the request may not outlast the job making it
+            left = max(deadline - time.time(), 0.001)
+            timeout = left if timeout is None else min(timeout, left)
+        post = len(self._base_url) + len(query) > self._max_url_length
+        headers = None
+        if post:
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+            if self._compress_requests:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                query = compressor.compress(query) + compressor.flush()
+                headers['Content-Encoding'] = 'gzip'
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("submitting %s request %s", 'POST' if post else 'GET',
+                (self._base_url + urllib.urlencode(self._redact(arguments)))
+                [:MAX_LOGGED_BODY])
+        event = self._local.event = RequestEvent(task_id,
+            len(self._base_url) + len(query))
+        for hook in self._hooks:
+            hook.before_request(event)
+        start = time.time()
+        try:
+            if post:
+                response = self._http.post(self._base_url.rstrip('?&'),
+                    data=query, headers=headers, stream=stream,
+                    timeout=timeout)
+            else:
+                response = self._http.get(self._base_url + query,
+                    stream=stream, timeout=timeout)
+            elapsed = response.elapsed
+            event.ttfb = elapsed.days * 86400 + elapsed.seconds + \
+                elapsed.microseconds / 1e6
+            if not stream:
+                event.bytes_received = len(response.content)
+                # bytes read from the socket, before decompression
+                event.bytes_compressed = response.raw.tell()
+                event.download = max(time.time() - start - event.ttfb, 0)
+            self._check_status(task_id, response)
+        except Exception as e:
+            event.error = e
+            self._notify_response(event, start)
+            raise
+        if stream:
+            response.raw.decode_content = True
+            return _CountingReader(response.raw, event, start,
+                self._notify_response)
+        self._notify_response(event, start)
+        logger.info("received %s bytes (%s compressed) for %s in %.3fs",
+            event.bytes_received, event.bytes_compressed, task_id,
+            event.elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("received response %s",
+                response.content[:MAX_LOGGED_BODY])
+        return response.content
+
+    def _notify_response(self, event, start):
+        """Sets the elapsed time of a request and calls the after_request
+        hooks.
+        """
+        event.elapsed = time.time() - start
+        for hook in self._hooks:
+            hook.after_request(event)
+
+    def _check_status(self, task_id, response):
+        """Raises an MstrRequestException for error statuses, using the
+        error code and message set by the Task Service in the headers.
+        """
+        if response.status_code < 400:
+            return
+        response.close()
+        code = response.headers.get('X-MSTR-TaskErrorCode')
+        message = response.headers.get('X-MSTR-TaskFailureMsg') or \
+            response.reason or ''
+        lowered = message.lower()
+        session_expired = code in SESSION_ERROR_CODES or \
+            lowered.strip() in SESSION_ERROR_MESSAGES
+        policy = self._retry_policy
+        retriable = not session_expired and ('memory' in lowered or
+            response.status_code in (policy.statuses if policy else ()))
+        raise MstrRequestException("Request for %s failed with status %s: "
+            "%s" % (task_id, response.status_code, message),
+            response.status_code, code, retriable, session_expired)
+
+    def _relogin(self, session):
+        """Replaces an expired session by a new one, unless another thread
+        has already done so, and returns the current session.
+        """
+        with self._login_lock:
+            if self._session == session:
+                logger.info("session expired, logging in again.")
+                new_session = self._login(*self._credentials)
+                if self._session_pool:
+                    self._session_pool.replace(session, new_session)
+                self._session = new_session
+            return self._session
+
+    def _redact(self, arguments):
+        if 'password' not in arguments:
+            return arguments
+        return dict(arguments, password='*****')
+
+    def _parsed(self, rows, seconds):
+        """Records the parsing of the response to the last request made
+        by the current thread, and notifies the hooks.
+        """
+        event = getattr(self._local, 'event', None)
+        if event is None:
+            return
+        event.rows = rows
+        event.parse = seconds
+        for hook in self._hooks:
+            hook.after_parse(event)
+
+
+class MstrSessionPool(object):
+    """Pool of authenticated sessions shared between MstrClient objects.
+
+    Sessions are kept for each (base_url, project_source, project_name,
+    username). A client created with a pool takes an idle session from it
+    instead of logging in, and returns the session to the pool instead of
+    logging out. Sessions that have been idle for more than max_idle
+    seconds are checked with a lightweight request before being handed
+    out, and replaced by a new login if the server no longer accepts them.
+    The pool is safe to share between threads.
+
+    Args:
+        max_size (int): maximum number of sessions per key. Clients wait
+            for a session to be released once this many are in use
+        max_idle (int): seconds after which an idle session is checked
+            before being reused
+        logout_timeout (float): timeout in seconds of the logout requests
+            made when the pool is closed
+    """
+    def __init__(self, max_size=4, max_idle=300, logout_timeout=10):
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._logout_timeout = logout_timeout
+        self._closed = False
+        self._condition = threading.Condition()
+        self._idle = {}
+        self._sizes = {}
+        self._keys = {}
+
+    def __str__(self):
+        return 'MstrSessionPool with %s sessions' % sum(self._sizes.values())
+
+    def acquire(self, mstr_client, project_source, project_name, username,
+            password):
+        """Returns a session for the client, logging in if there is no
+        idle session for these credentials.
+
+        Args:
+            mstr_client (MstrClient): client used to log in or check
+                the session
+            project_source (str): project source of form ip-####
+            project_name (str): name of project
+            username (str): username for project
+            password (str): password for project
+
+        Returns:
+            str: the session state
+        """
+        key = (mstr_client._base_url, project_source, project_name, username)
+        session = None
+        with self._condition:
+            while True:
+                if self._idle.get(key):
+                    session, released = self._idle[key].pop()
+                    break
+                if self._sizes.get(key, 0) < self._max_size:
+                    self._sizes[key] = self._sizes.get(key, 0) + 1
+                    break
+                self._condition.wait()
+        try:
+            if session and time.time() - released > self._max_idle and \
+                    not mstr_client._session_alive(session):
+                logger.info("discarding expired session.")
+                session = None
+            if not session:
+                session = mstr_client._login(project_source, project_name,
+                    username, password)
+        except:
+            with self._condition:
+                self._sizes[key] -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._keys[session] = key
+        return session
+
+    def replace(self, session, new_session):
+        """Replaces an acquired session which has expired by a new one.
+
+        Args:
+            session (str): the expired session state
+            new_session (str): the session state replacing it
+        """
+        with self._condition:
+            self._keys[new_session] = self._keys.pop(session)
+
+    def release(self, session):
+        """Returns a session acquired from this pool.
+
+        Args:
+            session (str): the session state
+
+        Returns:
+            bool: False if the pool has been closed, in which case the
+                session is not kept and should be logged out by the caller
+        """
+        with self._condition:
+            key = self._keys.pop(session)
+            if self._closed:
+                self._sizes[key] -= 1
+            else:
+                self._idle.setdefault(key, []).append((session, time.time()))
+            self._condition.notify()
+            return not self._closed
+
+    def close(self):
+        """Logs out all the idle sessions of the pool. Sessions in use are
+        logged out by their client once released.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+            for key, sessions in idle.items():
+                self._sizes[key] -= len(sessions)
+        for key, sessions in idle.items():
+            for session, released in sessions:
+                arguments = {'sessionState': session, 'taskId': 'logout'}
+                arguments.update(BASE_PARAMS)
+                try:
+                    requests.get(key[0] + urllib.urlencode(arguments),
+                        timeout=self._logout_timeout)
+                except requests.exceptions.RequestException as e:
+                    logger.warning("failed to log out session: %s", e)
+
+
+class RetryPolicy(object):
+    """Decides which failed requests of an MstrClient are retried, and how
+    long to wait before retrying.
+
+    Connection errors, timeouts, responses with one of the given http
+    statuses and server memory errors are retried. The wait doubles after
+    every attempt, and is shortened by a random fraction of up to jitter
+    so that clients failing together do not retry together.
+
+    Args:
+        retries (int): maximum number of retries of a request
+        backoff (float): seconds to wait before the first retry
+        max_backoff (float): maximum number of seconds between attempts
+        jitter (float): maximum fraction of the wait randomly removed,
+            between 0 and 1
+        statuses (tuple): http statuses of the responses to retry
+        task_retries (dict): maps a task id (e.g. 'reportExecute') to its
+            maximum number of retries, overriding retries
+    """
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, jitter=0.5,
+            statuses=(502, 503, 504), task_retries=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = tuple(statuses)
+        self.task_retries = task_retries or {}
+
+    def retries_for(self, task_id):
+        return self.task_retries.get(task_id, self.retries)
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait after a failed attempt,
+        counted from 1.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker(object):
+    """Fails requests immediately while the server is failing, rather than
+    adding to its load.
+
+    The breaker opens after failure_threshold consecutive failed requests,
+    failing requests with an MstrClientException. After reset_timeout
+    seconds a single request is let through: the breaker closes if it
+    succeeds and opens again otherwise. Responses with non retriable
+    errors, such as an invalid report, count as successes. A breaker may
+    be shared by the clients of a server, and is safe to share between
+    threads.
+
+    Args:
+        failure_threshold (int): number of consecutive failures opening
+            the breaker
+        reset_timeout (float): seconds after which a request is let
+            through an open breaker
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    def state(self):
+        """Returns 'closed', 'open' or 'half-open', the latter when a
+        request may be let through to test the server.
+        """
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            if self._trial or \
+                    time.time() - self._opened < self._reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def before_request(self):
+        """Raises an MstrClientException if the breaker is open.
+        """
+        with self._lock:
+            if self._opened is None:
+                return
+            if self._trial or \
+                    time.time() - self._opened < self._reset_timeout:
+                raise MstrClientException("Circuit breaker open after %s "
+                    "failed requests." % self._failures)
+            self._trial = True
+
+    def record(self, success):
+        """Records the outcome of a request let through the breaker.
+        """
+        with self._lock:
+            self._trial = False
+            if success:
+                self._failures = 0
+                self._opened = None
+                return
+            self._failures += 1
+            if self._opened is not None or \
+                    self._failures >= self._failure_threshold:
+                self._opened = time.time()
+
+
+class MemoryCache(object):
+    """In memory cache with least recently used eviction and expiry.
+
+    Values are returned as stored, so they should not be modified by
+    the caller. The cache is safe to share between threads.
+
+    Args:
+        max_size (int): maximum number of entries
+        ttl (int): default number of seconds an entry is kept
+
+    Attributes:
+        hits (int): number of lookups that found a live entry
+        misses (int): number of lookups that did not
+    """
+    def __init__(self, max_size=1024, ttl=300):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly linked list of [prev, next, key], most
+        # recently used last
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value stored for key, or None if there is no live
+        entry for it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            link = entry[2]
+            link[0][1], link[1][0] = link[1], link[0]
+            self._append(link)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Stores value for key for ttl seconds, or the default ttl of the
+        cache if not supplied.
+        """
+        if ttl is None:
+            ttl = self._ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            elif len(self._entries) >= self._max_size:
+                self._remove(self._root[1][2])
+            link = [None, None, key]
+            self._append(link)
+            self._entries[key] = (value, time.time() + ttl, link)
+
+    def invalidate(self, prefix=None):
+        """Removes the entries whose key starts with prefix, or all of
+        them if prefix is not supplied.
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                if prefix is None or key.startswith(prefix):
+                    self._remove(key)
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0], link[1] = last, self._root
+        last[1] = self._root[0] = link
+
+    def _remove(self, key):
+        link = self._entries.pop(key)[2]
+        link[0][1], link[1][0] = link[1], link[0]
+
+
+class SqliteCache(object):
+    """Cache stored in a sqlite database, which can be shared by several
+    processes on the same host.
+
+    Values are pickled, so they must be plain python data. Expired entries
+    are purged when a value is stored, and once a limit is exceeded the
+    entries closest to expiry are evicted first.
+
+    Args:
+        path (str): path of the database file, created if needed
+        ttl (int): default number of seconds an entry is kept
+        max_size (int): maximum number of entries
+        max_bytes (int): if supplied, maximum total size of the pickled
+            values. A value larger than this on its own is not stored
+
+    Attributes:
+        hits (int): number of lookups from this process that found a live
+            entry
+        misses (int): number of lookups from this process that did not
+    """
+    def __init__(self, path, ttl=300, max_size=1024, max_bytes=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT " +
+                "PRIMARY KEY, value BLOB, expires REAL)")
+            self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        """Returns the value stored for key, or None if there is no live
+        entry for it.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM cache WHERE key = ? " +
+                "AND expires >= ?", (key, time.time())).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, value, ttl=None):
+        """Stores value for key for ttl seconds, or the default ttl of the
+        cache if not supplied.
+        """
+        if ttl is None:
+            ttl = self._ttl
+        value = sqlite3.Binary(pickle.dumps(value, 2))
+        with self._lock:
+            if self._max_bytes is not None and len(value) > self._max_bytes:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO cache VALUES " +
+                    "(?, ?, ?)", (key, value, time.time() + ttl))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Deletes the expired entries, then the entries closest to expiry
+        until the size limits are met. Called with the lock held.
+        """
+        self._db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        self._db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM " +
+            "cache ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self._max_size,))
+        if self._max_bytes is None:
+            return
+        total = 0
+        evicted = []
+        for key, size in self._db.execute("SELECT key, length(value) FROM " +
+                "cache ORDER BY expires DESC"):
+            total += size
+            if total > self._max_bytes:
+                evicted.append((key,))
+        self._db.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def invalidate(self, prefix=None):
+        """Removes the entries whose key starts with prefix, or all of
+        them if prefix is not supplied.
+        """
+        with self._lock:
+            if prefix is None:
+                self._db.execute("DELETE FROM cache")
+            else:
+                self._db.execute("DELETE FROM cache WHERE substr(key, 1, ?) " +
+                    "= ?", (len(prefix), prefix))
+            self._db.commit()
+
+
+class RequestHooks(object):
+    """Base class of the objects notified of the requests made by an
+    MstrClient, see the hooks argument of MstrClient.
+
+    Each method receives the RequestEvent of the request, and is called
+    from the thread making the request. The methods do nothing by default.
+    """
+    def before_request(self, event):
+        """Called before a request is sent.
+        """
+
+    def after_request(self, event):
+        """Called once the response has been received, or the request has
+        failed. For streamed responses, this is once the body has been read
+        to its end or closed.
+        """
+
+    def after_parse(self, event):
+        """Called once a report execution has been parsed.
+        """
+
+
+class RequestEvent(object):
+    """Measurements of a request made by an MstrClient.
+
+    The requests library does not expose the time taken to connect, which
+    is included in ttfb.
+
+    Attributes:
+        task_id (str): the task of the request, e.g. 'reportExecute'
+        bytes_sent (int): length of the request url
+        bytes_received (int): length of the response body, once
+            decompressed
+        bytes_compressed (int): length of the response body as sent by
+            the server, which is bytes_received unless it was compressed
+        ttfb (float): seconds until the headers of the response were
+            received
+        download (float): seconds spent downloading the body. For streamed
+            responses this includes the parsing done while reading it
+        elapsed (float): total seconds spent on the request
+        parse (float): seconds spent parsing a report execution. For
+            streamed responses this includes the download
+        rows (int): number of rows of a report execution
+        error (Exception): exception raised by a failed request
+    """
+    __slots__ = ('task_id', 'bytes_sent', 'bytes_received',
+        'bytes_compressed', 'ttfb', 'download', 'elapsed', 'parse', 'rows',
+        'error')
+
+    def __init__(self, task_id, bytes_sent):
+        self.task_id = task_id
+        self.bytes_sent = bytes_sent
+        self.bytes_received = None
+        self.bytes_compressed = None
+        self.ttfb = None
+        self.download = None
+        self.elapsed = None
+        self.parse = None
+        self.rows = None
+        self.error = None
+
+    def __repr__(self):
+        return "<RequestEvent: task:%s elapsed:%s bytes:%s>" % (self.task_id,
+            self.elapsed, self.bytes_received)
+
+
+class _CountingReader(object):
+    """File-like object over the body of a streamed response, which is
+    decompressed as it is read so that the parser never holds the whole
+    body. Once the body has been read to its end or closed, the sizes of
+    the body before and after decompression are set on the event of the
+    request and notify is called. The connection goes back to the pool
+    once the body has been read, and is dropped if it is closed before.
+    """
+
+    def __init__(self, raw, event, start, notify):
+        self._raw = raw
+        self._event = event
+        self._start = start
+        self._notify = notify
+        self._read = 0
+        self._done = False
+
+    def read(self, size=-1):
+        data = self._raw.read(size if size >= 0 else None)
+        self._read += len(data)
+        if size < 0 or not data and size != 0:
+            if not self._done:
+                self._raw.release_conn()
+            self._finish()
+        return data
+
+    def close(self):
+        if not self._done:
+            self._raw.close()
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            return
+        self._done = True
+        event = self._event
+        event.bytes_received = self._read
+        event.bytes_compressed = self._raw.tell()
+        event.download = max(time.time() - self._start - event.ttfb, 0)
+        self._notify(event, self._start)
+
+
+class Histogram(object):
+    """Distribution of measurements, counted in buckets whose upper bounds
+    grow exponentially.
+
+    Args:
+        start (float): upper bound of the first bucket
+        factor (float): ratio between the bounds of two successive buckets
+        buckets (int): number of buckets. Larger values are counted in an
+            extra, unbounded bucket
+
+    Attributes:
+        count (int): number of measurements
+        total (float): sum of the measurements
+        min (float): smallest measurement
+        max (float): largest measurement
+    """
+    def __init__(self, start=0.001, factor=2, buckets=32):
+        self.bounds = [start * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __repr__(self):
+        return "<Histogram: count:%s mean:%s max:%s>" % (self.count,
+            self.mean(), self.max)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def percentile(self, percent):
+        """Returns an upper estimate of the given percentile (0-100): the
+        bound of the bucket holding it, or the largest measurement if
+        smaller.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class MetricsCollector(RequestHooks):
+    """Collects histograms of the request measurements of an MstrClient,
+    for each task.
+
+    The measurements are the names of the RequestEvent attributes:
+    'elapsed', 'ttfb', 'download', 'parse' (seconds), 'bytes_sent',
+    'bytes_received', 'bytes_compressed' and 'rows'.
+
+    Attributes:
+        errors (dict): number of failed requests of each task
+    """
+    _starts = {'bytes_sent': 64, 'bytes_received': 1024,
+        'bytes_compressed': 1024, 'rows': 1}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self.errors = {}
+
+    def after_request(self, event):
+        with self._lock:
+            if event.error is not None:
+                self.errors[event.task_id] = \
+                    self.errors.get(event.task_id, 0) + 1
+            self._add(event, ('elapsed', 'ttfb', 'download', 'bytes_sent',
+                'bytes_received', 'bytes_compressed'))
+
+    def after_parse(self, event):
+        with self._lock:
+            self._add(event, ('parse', 'rows'))
+
+    def histogram(self, task_id, name):
+        """Returns the Histogram of a measurement for a task, or None if
+        nothing was measured.
+        """
+        return self._histograms.get((task_id, name))
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Returns a dictionary mapping each task to a dictionary of its
+        measurements. Each measurement is summarized as a dictionary of
+        its count, mean, max and percentiles, e.g. 'p95'.
+        """
+        result = {}
+        with self._lock:
+            for (task_id, name), histogram in self._histograms.items():
+                stats = {'count': histogram.count, 'mean': histogram.mean(),
+                    'max': histogram.max}
+                for percent in percentiles:
+                    stats['p%s' % percent] = histogram.percentile(percent)
+                result.setdefault(task_id, {})[name] = stats
+        return result
+
+    def _add(self, event, names):
+        for name in names:
+            value = getattr(event, name)
+            if value is None:
+                continue
+            histogram = self._histograms.get((event.task_id, name))
+            if histogram is None:
+                histogram = self._histograms[(event.task_id, name)] = \
+                    Histogram(self._starts.get(name, 0.001))
+            histogram.add(value)
 
 
 class Singleton(type):
@@ -167,21 +1449,27 @@ class Singleton(type):
 
     Objects are considered to be the same, and thus a new object
     does not need to be instantiated, if an object with that guid
-    already exists.
+    already exists. The class instances are held through weak
+    references, so an object is dropped once it is no longer used.
     """
+    _lock = threading.Lock()
+
     def __call__(cls, *args, **kwargs):
         """Called when a new Singleton object is created.
 
         Singleton class checks to see if there is already a copy
         of the object in the class instances, and if so returns
         that object. Otherwise, it creates a new object of that
-        subclass type.
+        subclass type. The check and creation happen under a lock, so
+        concurrent threads always get the same object for a guid.
         """
-        # see if guid is in instances
-        if args[0] not in cls._instances:
-            cls._instances[args[0]] = super(Singleton, cls).__call__(*args,
-                **kwargs)
-        return cls._instances[args[0]]
+        with Singleton._lock:
+            # see if guid is in instances
+            instance = cls._instances.get(args[0])
+            if instance is None:
+                instance = super(Singleton, cls).__call__(*args, **kwargs)
+                cls._instances[args[0]] = instance
+            return instance
 
 
 class Attribute(object):
@@ -200,7 +1488,8 @@ class Attribute(object):
         name (str): attribute name
     """
     __metaclass__ = Singleton
-    _instances = {}
+    __slots__ = ('guid', 'name', '__weakref__')
+    _instances = weakref.WeakValueDictionary()
     def __init__(self, guid, name):
         self.guid = guid
         self.name = name
@@ -227,7 +1516,8 @@ class Metric(object):
         name (str): the name of this metric
     """
     __metaclass__ = Singleton
-    _instances = {}
+    __slots__ = ('guid', 'name', '__weakref__')
+    _instances = weakref.WeakValueDictionary()
     def __init__(self, guid, name):
         self.guid = guid
         self.name = name
@@ -262,6 +1552,7 @@ class Prompt(object):
         attribute (Attribute): Attribute object associated with the
             prompt if it is an element prompt
     """
+    __slots__ = ('guid', 'prompt_str', 'required', 'attribute')
     def __init__(self, guid, prompt_str, required, attribute=None):
         self.guid = guid
         self.prompt_str = prompt_str
@@ -275,26 +1566,83 @@ class Prompt(object):
         return "Prompt: %s - %s" % (self.guid, self.prompt_str)
 
 
+class _ReportDefinition(object):
+    """Prompts and column objects of a report, kept by the client so that
+    they are only retrieved once for all the Report objects of a guid.
+
+    Attributes:
+        prompts (list): Prompt objects, None until retrieved
+        headers (list): Attribute/Metric objects of the columns
+        attributes (list): Attribute objects of the columns
+        metrics (list): Metric objects of the columns
+        lock (Lock): held while the headers are set
+    """
+    __slots__ = ('prompts', 'headers', 'attributes', 'metrics', 'lock')
+
+    def __init__(self):
+        self.prompts = None
+        self.headers = []
+        self.attributes = []
+        self.metrics = []
+        self.lock = threading.Lock()
+
+
+def _definition_property(name):
+    """Property reading and setting an attribute of the _ReportDefinition
+    of a report.
+    """
+    return property(lambda self: getattr(self._definition, name),
+        lambda self, value: setattr(self._definition, name, value))
+
+
 class Report(object):
     """Encapsulates a report in MicroStrategy
 
     The most common use case will be to execute a report.
 
+    A report can be executed from several threads at once. Each execution
+    returns its own ReportResult, which should be used rather than
+    get_values when sharing a report between threads, as get_values only
+    returns the rows of the last execution to complete.
+
+    The prompts, headers and attributes of a report are retrieved once per
+    client and shared by the Report objects with the same guid, see
+    MstrClient.clear_report_definitions.
+
     Args:
         mstr_client (MstrClient): client to be used to
             make requests
         report_id (str): report guid
     """
 
+    # reportExecute arguments selecting the rows and columns returned, and
+    # answering the prompts
+    _window_keys = ('startRow', 'startCol', 'maxRows', 'maxCols',
+        'styleName', 'resultFlags')
+    _answer_keys = ('valuePromptAnswers', 'elementsPromptAnswers',
+        'promptsAnswerXML')
+
     def __init__(self, mstr_client, report_id):
         self._mstr_client = mstr_client
         self._id = report_id
-        self._args = {'reportID': self._id,'sessionState': mstr_client._session}
-        self._attributes = []
-        self._metrics = []
-        self._headers = []
+        self._lock = threading.Lock()
+        self._definition = mstr_client._definition(report_id)
+        # msgID and session of the execution left in prompt status by
+        # get_prompts, answered by the next prompted execution
+        self._message = None
         self._values = None
 
+    _headers = _definition_property('headers')
+    _attributes = _definition_property('attributes')
+    _metrics = _definition_property('metrics')
+
+    @property
+    def _args(self):
+        # the session is read on each request, as it changes when the
+        # client logs in again
+        return {'reportID': self._id,
+            'sessionState': self._mstr_client._session}
+
     def __str__(self):
         return 'Report with id %s' % self._id
 
@@ -302,6 +1650,11 @@ class Report(object):
         """ Returns the prompts associated with this report. If there are
             no prompts, this method raises an error.
 
+            The prompts are retrieved by executing the report, which stops
+            in prompt status. The next execution of this Report object
+            given prompt answers, other than a streamed one, answers them
+            on that execution instead of starting a new one.
+
         Returns: 
             list: a list of Prompt objects
 
@@ -310,12 +1663,16 @@ class Report(object):
                 likely implying there are no prompts for this report.
         """
 
+        if self._definition.prompts is not None:
+            return self._definition.prompts
         arguments = {'taskId': 'reportExecute'}
         arguments.update(self._args)
         response = self._mstr_client._request(arguments)
         message = pq(response)('msg')('id')
         if not message:
-            logger.debug("failed retrieval of msgID in response %s" % response)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("failed retrieval of msgID in response %s",
+                    response[:MAX_LOGGED_BODY])
             raise MstrReportException("Error retrieving msgID for report. Most" 
                 + " likely the report does not have any prompts.")
             return
@@ -327,7 +1684,10 @@ class Report(object):
             'sessionState': self._mstr_client._session
         }
         response = self._mstr_client._request(arguments)
-        return self._parse_prompts(response)
+        prompts = self._definition.prompts = self._parse_prompts(response)
+        with self._lock:
+            self._message = (message_id, arguments['sessionState'])
+        return prompts
 
     def _parse_prompts(self, response):
         """ There are many ways that prompts can be returned. This api
@@ -421,7 +1781,8 @@ class Report(object):
         raise MstrReportException("Execute a report before viewing the metrics")
 
     def execute(self, start_row=0, start_col=0, max_rows=100000, max_cols=255,
-                value_prompt_answers=None, element_prompt_answers=None):
+                value_prompt_answers=None, element_prompt_answers=None,
+                stream=False, typed=False):
         """Execute a report.
 
         Executes a report with the specified parameters. Default values
@@ -444,11 +1805,332 @@ class Report(object):
             element_prompt_answers: (dict) element prompt answers represented as a
                 dictionary of Prompt objects (with attr field specified)
                 mapping to a list of attribute values to pass
+            stream (bool): if True, the rows are not stored on the report.
+                Instead a generator is returned, see iter_rows
+            typed (bool): if True, the values are converted from strings
+                according to the type of their column, see
+                ReportResult.convert
+
+        Returns:
+            ReportResult: the headers and rows of this execution
+
+        Raises:
+            MstrReportException: if there was an error executing the report.
+        """
+
+        if stream:
+            return self.iter_rows(start_row, start_col, max_rows, max_cols,
+                value_prompt_answers, element_prompt_answers)
+        arguments = self._execute_args(start_row, start_col, max_rows,
+            max_cols, value_prompt_answers, element_prompt_answers)
+        result = self._fetch(arguments)
+        if typed:
+            result = result.convert()
+        return self._record(result)
+
+    def execute_paged(self, page_size=10000, concurrency=4, start_col=0,
+                max_cols=255, value_prompt_answers=None,
+                element_prompt_answers=None, total_rows=None, typed=False):
+        """Execute a report in windows of page_size rows.
+
+        The first page is retrieved on its own, after which the following
+        windows are requested concurrency at a time over the same session.
+        Rows are stored in report order, as with execute. Paging stops at
+        the first page holding less than page_size rows, or once total_rows
+        rows have been requested if the row count is known, either given
+        or as returned by the server with the first page.
+
+        Args:
+            page_size (int): number of rows retrieved with each request
+            concurrency (int): maximum number of pages requested at once
+            start_col (int): first column number to be returned
+            max_cols (int): maximum number of columns to return
+            value_prompt_answers (list): see execute
+            element_prompt_answers (dict): see execute
+            total_rows (int): total number of rows in the report, if known.
+                Defaults to the count returned by the server, if any
+            typed (bool): if True, the values are converted from strings
+                according to the type of their column
+
+        Returns:
+            ReportResult: the headers and rows of this execution
 
         Raises:
             MstrReportException: if there was an error executing the report.
         """
 
+        def fetch(start_row):
+            return self._fetch(self._execute_args(start_row, start_col,
+                page_size, max_cols, value_prompt_answers,
+                element_prompt_answers))
+
+        first = fetch(0)
+        if len(first) < page_size:
+            return self._record(first.convert() if typed else first)
+        if total_rows is None:
+            total_rows = first.total_rows
+        values = list(first.get_values())
+        pool = ThreadPool(concurrency)
+        try:
+            start_row = page_size
+            while total_rows is None or start_row < total_rows:
+                end_row = start_row + concurrency * page_size
+                if total_rows is not None:
+                    end_row = min(end_row, total_rows)
+                pages = pool.map(fetch, range(start_row, end_row, page_size))
+                for page in pages:
+                    values.extend(page.get_values())
+                if len(pages[-1]) < page_size:
+                    break
+                start_row = end_row
+        finally:
+            pool.close()
+            pool.join()
+        result = ReportResult(first.headers, values, first.types,
+            first.total_rows)
+        return self._record(result.convert() if typed else result)
+
+    def execute_partitioned(self, prompt, values, partition_size=10,
+                max_workers=4, start_col=0, max_rows=100000, max_cols=255,
+                value_prompt_answers=None, element_prompt_answers=None,
+                typed=False):
+        """Execute a report once for each partition of the answers of an
+        element prompt, merging the rows of the executions.
+
+        Reports which time out when the prompt is answered with every value
+        at once are run as several smaller executions, max_workers at a
+        time over the same session. The rows are stored in the order of
+        the partitions. This is only equivalent to a single execution if
+        each row belongs to a single element of the prompt, e.g. when the
+        prompted attribute is a column of the report: subtotals are
+        computed for each partition.
+
+        Args:
+            prompt (Prompt): the element prompt to partition, with its
+                attribute set
+            values (list): the answers of the prompt
+            partition_size (int): maximum number of answers of each
+                execution
+            max_workers (int): maximum number of executions run at once
+            start_col (int): first column number to be returned
+            max_rows (int): maximum number of rows of each execution
+            max_cols (int): maximum number of columns to return
+            value_prompt_answers (list): see execute
+            element_prompt_answers (dict): answers of the other element
+                prompts, see execute
+            typed (bool): if True, the values are converted from strings
+                according to the type of their column
+
+        Returns:
+            ReportResult: the headers and rows of all the executions
+
+        Raises:
+            MstrReportException: if there was an error executing the report,
+                or if the executions returned different headers.
+        """
+
+        values = list(values)
+        partitions = [values[i:i + partition_size]
+            for i in range(0, len(values), partition_size)] or [[]]
+
+        def fetch(partition):
+            answers = dict(element_prompt_answers or {})
+            answers[prompt] = partition
+            return self._fetch(self._execute_args(0, start_col, max_rows,
+                max_cols, value_prompt_answers, answers))
+
+        pool = ThreadPool(min(max_workers, len(partitions)))
+        try:
+            results = pool.map(fetch, partitions)
+        finally:
+            pool.close()
+            pool.join()
+        first = None
+        rows = []
+        for result in results:
+            if first is None or not first.headers:
+                first = result
+            elif result.headers and result.headers != first.headers:
+                raise MstrReportException("The partitions of report %s " %
+                    self._id + "returned different headers: %s and %s" % (
+                    first.headers, result.headers))
+            rows.extend(result.get_values())
+        result = ReportResult(first.headers, rows, first.types)
+        return self._record(result.convert() if typed else result)
+
+    def submit(self, start_row=0, start_col=0, max_rows=100000, max_cols=255,
+                value_prompt_answers=None, element_prompt_answers=None):
+        """Starts executing a report on the server without waiting for it
+        to complete.
+
+        Accepts the same arguments as execute. The server is asked to
+        return immediately with the msgID of the execution, which the
+        returned ReportExecution uses to poll for the results, so no
+        connection is held open while the report runs. Several reports can
+        be submitted and then collected with wait_all.
+
+        Returns:
+            ReportExecution: handle on the execution
+
+        Raises:
+            MstrReportException: if there was an error executing the report.
+        """
+
+        arguments = self._execute_args(start_row, start_col, max_rows,
+            max_cols, value_prompt_answers, element_prompt_answers)
+        window = dict([(k, arguments[k]) for k in self._window_keys])
+        arguments['maxWait'] = 0
+        return ReportExecution(self, window,
+            self._mstr_client._request(arguments))
+
+    def iter_rows(self, start_row=0, start_col=0, max_rows=100000, max_cols=255,
+                value_prompt_answers=None, element_prompt_answers=None):
+        """Execute a report, yielding its rows while they are downloaded.
+
+        Accepts the same arguments as execute. The response is parsed
+        incrementally, so each row is yielded as soon as it has been
+        received and is then discarded, keeping memory usage flat
+        regardless of the size of the report. The headers are available
+        through get_headers once the first row has been yielded.
+
+        Yields:
+            list: a list of (Attribute/Metric, value) tuples for each row
+
+        Raises:
+            MstrReportException: if there was an error executing the report.
+        """
+
+        arguments = self._execute_args(start_row, start_col, max_rows,
+            max_cols, value_prompt_answers, element_prompt_answers)
+        source = self._mstr_client._request(arguments, stream=True)
+        stream = _ReportStream(source)
+        rows = 0
+        seconds = 0
+        start = time.time()
+        try:
+            for values in stream:
+                if not rows:
+                    # the headers precede the rows, so they are complete
+                    self._set_headers(stream.headers)
+                rows += 1
+                # the time spent by the caller between rows is not counted
+                seconds += time.time() - start
+                yield zip(stream.headers, values)
+                start = time.time()
+            seconds += time.time() - start
+            if not rows:
+                self._set_headers(stream.headers)
+            self._mstr_client._parsed(rows, seconds)
+        finally:
+            # stopping early or on an error must still free the connection
+            source.close()
+
+    def to_columns(self, start_row=0, start_col=0, max_rows=100000,
+                max_cols=255, value_prompt_answers=None,
+                element_prompt_answers=None):
+        """Execute a report, returning its values column by column.
+
+        Accepts the same arguments as execute. The columns are filled while
+        the response is parsed, without building the per row lists of
+        tuples that execute stores, see ReportColumns. If the client has a
+        parse pool, the response is parsed by one of its processes.
+
+        Returns:
+            ReportColumns: the values of the report
+
+        Raises:
+            MstrReportException: if there was an error executing the report.
+        """
+
+        arguments = self._execute_args(start_row, start_col, max_rows,
+            max_cols, value_prompt_answers, element_prompt_answers)
+        source = self._mstr_client._request(arguments, stream=True)
+        pool = self._mstr_client._parse_pool
+        try:
+            if pool is None:
+                start = time.time()
+                columns = _read_columns(source)
+            else:
+                # the raw bytes are sent, the process decodes them itself
+                data = source.read()
+                start = time.time()
+                columns = pool.apply(_read_columns, (data,))
+        finally:
+            source.close()
+        self._mstr_client._parsed(len(columns), time.time() - start)
+        self._set_headers(columns.headers)
+        return columns
+
+    def export(self, path, format='csv', chunk_rows=10000, start_col=0,
+                max_cols=255, value_prompt_answers=None,
+                element_prompt_answers=None):
+        """Executes a report and writes its values to a file.
+
+        The report is retrieved in pages of chunk_rows rows, each page
+        being appended to the file as it arrives while the next one is
+        downloaded, so at most two pages are held in memory. The rows are
+        not stored on the report.
+
+        For parquet and arrow files the schema is built from the headers:
+        metrics are doubles, and attributes are typed according to their
+        form, see convert_column, big decimals being kept as strings.
+
+        Args:
+            path (str): path of the file to write
+            format (str): 'csv', 'parquet' or 'arrow'. pyarrow must be
+                installed for the latter two
+            chunk_rows (int): number of rows requested at once
+            start_col, max_cols, value_prompt_answers,
+                element_prompt_answers: see execute
+
+        Returns:
+            int: the number of rows written
+
+        Raises:
+            MstrReportException: if there was an error executing the report
+                or the format is not supported.
+        """
+
+        if format not in ('csv', 'parquet', 'arrow'):
+            raise MstrReportException("Unsupported export format: %s" % format)
+        if format != 'csv' and pyarrow is None:
+            raise MstrReportException("pyarrow must be installed to export " +
+                "to %s" % format)
+
+        def fetch(start_row):
+            return self._fetch(self._execute_args(start_row, start_col,
+                chunk_rows, max_cols, value_prompt_answers,
+                element_prompt_answers))
+
+        pool = ThreadPool(1)
+        writer = None
+        rows = 0
+        try:
+            pending = pool.apply_async(fetch, (0,))
+            while pending is not None:
+                result = pending.get()
+                pending = None
+                if len(result) == chunk_rows:
+                    pending = pool.apply_async(fetch, (rows + chunk_rows,))
+                if writer is None:
+                    self._set_headers(result.headers)
+                    if format == 'csv':
+                        writer = _CsvWriter(path, result.headers)
+                    else:
+                        writer = _ArrowWriter(path, result.headers,
+                            result.types, format)
+                if len(result):
+                    writer.write(result)
+                rows += len(result)
+        finally:
+            pool.close()
+            pool.join()
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def _execute_args(self, start_row, start_col, max_rows, max_cols,
+                value_prompt_answers, element_prompt_answers):
         arguments = {
             'taskId': 'reportExecute',
             'startRow': start_row,
@@ -466,108 +2148,997 @@ class Report(object):
         elif element_prompt_answers:
             arguments.update(self._format_element_prompts(element_prompt_answers))
         arguments.update(self._args)
+        return arguments
+
+    def _fetch(self, arguments):
+        """Returns the ReportResult for the reportExecute arguments, reusing
+        the result from the result cache of the client if possible. The
+        state of the report is left untouched.
+        """
+        cache = self._mstr_client._result_cache
+        if cache is None:
+            return self._request_result(arguments)
+        key = self._result_key(arguments)
+        data = cache.get(key)
+        if data is not None:
+            logger.info("using cached result for report %s" % self._id)
+            return self._load_result(data)
+        result = self._request_result(arguments)
+        cache.set(key, self._dump_result(result))
+        return result
+
+    def _request_result(self, arguments):
+        message_id = self._take_message(arguments)
+        if message_id is not None:
+            return self._answer_prompts(message_id, arguments)
         response = self._mstr_client._request(arguments)
-        self._values = self._parse_report(response)
+        start = time.time()
+        result = self._parse_report(response)
+        self._mstr_client._parsed(len(result), time.time() - start)
+        return result
+
+    def _take_message(self, arguments):
+        """Returns the msgID left by get_prompts if the arguments answer
+        prompts and it belongs to their session, so that it is only
+        answered once.
+        """
+        if not [key for key in self._answer_keys if key in arguments]:
+            return None
+        with self._lock:
+            message = self._message
+            if message is None or message[1] != arguments['sessionState']:
+                return None
+            self._message = None
+        return message[0]
+
+    def _answer_prompts(self, message_id, arguments):
+        """Answers the prompts of the execution left in prompt status by
+        get_prompts, and returns its ReportResult for the window of the
+        reportExecute arguments once the execution has completed.
+        """
+        answer = {
+            'taskId': 'answerPrompts',
+            'objectType': '3',
+            'msgID': message_id,
+            'sessionState': arguments['sessionState']
+        }
+        answer.update([(key, arguments[key]) for key in self._answer_keys
+            if key in arguments])
+        response = self._mstr_client._request(answer)
+        window = dict([(key, arguments[key]) for key in self._window_keys])
+        execution = ReportExecution(self, window, message_id=message_id,
+            record=False)
+        # the answer holds no rows, only the status of the execution or an
+        # error, raised while parsing it
+        if not execution._pending(response):
+            self._parse_report(response)
+        return execution.wait()
+
+    def _result_key(self, arguments):
+        """Hashes the report, window and prompt answers of the arguments,
+        leaving out the session.
+        """
+        items = ['%s=%s' % (k, arguments[k]) for k in sorted(arguments)
+            if k != 'sessionState']
+        digest = hashlib.sha1('&'.join(items).encode('utf-8')).hexdigest()
+        return '%s|reportExecute|%s' % (self._mstr_client._cache_prefix,
+            digest)
+
+    def _dump_result(self, result):
+        """Serializes the headers and cell values as compressed json.
+        """
+        headers = [('attribute' if isinstance(h, Attribute) else 'metric',
+            h.guid, h.name) for h in result.headers]
+        rows = [[value for header, value in row] for row in result]
+        return zlib.compress(json.dumps({'headers': headers,
+            'types': result.types, 'total_rows': result.total_rows,
+            'rows': rows}, separators=(',', ':')))
+
+    def _load_result(self, data):
+        data = json.loads(zlib.decompress(data))
+        headers = [Attribute(guid, name) if kind == 'attribute'
+            else Metric(guid, name) for kind, guid, name in data['headers']]
+        return ReportResult(headers, [zip(headers, row)
+            for row in data['rows']], data.get('types'),
+            data.get('total_rows'))
+
+    # The answers are built as lists of parts joined once at the end, so
+    # that encoding stays linear in the number of values.
 
     def _format_xml_prompts(self, v_prompts, e_prompts):
-        result = "<rsl>"
+        parts = ["<rsl>"]
         for p, s in v_prompts:
-            result = result + "<pa pt='5' pin='0' did='" + p.guid + \
-                "' tp='10'>" + s + "</pa>"
-        result += "</rsl>"
+            parts.extend(["<pa pt='5' pin='0' did='", p.guid, "' tp='10'>", s,
+                "</pa>"])
+        parts.append("</rsl>")
         d = self._format_element_prompts(e_prompts)
-        d['promptsAnswerXML'] = result
+        d['promptsAnswerXML'] = ''.join(parts)
         return d
 
     def _format_value_prompts(self, prompts):
-        result = ''
-        for i, (prompt, s) in enumerate(prompts):
-            if i > 0:
-                result += '^'
-            if s:
-                result += s
-            elif not (s == '' and type(prompt) == Prompt):
+        parts = []
+        for prompt, s in prompts:
+            if not s and not (s == '' and type(prompt) == Prompt):
                 raise MstrReportException("Invalid syntax for value prompt " +
                     "answers. Must pass (Prompt, string) tuples")
-        return {'valuePromptAnswers': result}
+            parts.append(s)
+        return {'valuePromptAnswers': '^'.join(parts)}
 
     def _format_element_prompts(self, prompts):
-        result = ''
-        for prompt, values in prompts.iteritems():
-            if result:
-                result += ","
+        parts = []
+        # sorted so that the same answers always give the same string
+        for prompt, values in sorted(prompts.iteritems(),
+                key=lambda item: item[0].attribute.guid):
+            guid = prompt.attribute.guid
             if values:
-                prefix = ";" + prompt.attribute.guid + ":"
-                result = result + prompt.attribute.guid + ";" + prompt.attribute.guid + ":" + \
-                    prefix.join(values)
+                prefix = guid + ":"
+                parts.append(guid + ";" + prefix + (";" + prefix).join(values))
             else:
-                result += prompt.attribute.guid + ";"
-        return {'elementsPromptAnswers': result}
+                parts.append(guid + ";")
+        return {'elementsPromptAnswers': ','.join(parts)}
 
     def _parse_report(self, response):
-        d = pq(response)
-        if self._report_errors(d):
-            return None
-        if not self._headers:
-            self._get_headers(d)
-        # iterate through the columns while iterating through the rows
-        # and create a list of tuples with the attribute and value for that
-        # column for each row
-        return [[(self._headers[index], val.text) for index, val
-                in enumerate(row.iterchildren())] for row in d('r')]
-    
-    def _report_errors(self, d):
-        """ Performs error checking on the result from the execute
-        call. 
-
-        Specifically, this method is looking for the <error> tag
-        returned by MicroStrategy.
+        if not response:
+            return ReportResult([], [])
+        if isinstance(response, unicode):
+            response = response.encode('utf-8')
+        headers, types, values, total_rows = _ReportStream.parse(response)
+        headers = headers or []
+        return ReportResult(headers, [zip(headers, row) for row in values],
+            types, total_rows)
+
+    def _record(self, result):
+        """Stores the result as the last execution of the report.
+        """
+        self._set_headers(result.headers)
+        self._values = result.get_values()
+        return result
+
+    def _set_headers(self, headers):
+        """Stores the headers of the first execution of the report.
+        """
+        with self._definition.lock:
+            if self._headers or not headers:
+                return
+            self._attributes = [h for h in headers if isinstance(h, Attribute)]
+            self._metrics = [h for h in headers if isinstance(h, Metric)]
+            self._headers = list(headers)
+
+
+class ReportResult(object):
+    """Headers and rows returned by the execution of a report.
+
+    Every execution returns a new result which is not modified afterwards,
+    so results can be read from several threads without locking. The rows
+    are not copied, and should not be modified by the caller.
+
+    Args:
+        headers (list): Attribute/Metric objects for the columns
+        values (list): rows as lists of (Attribute/Metric, value) tuples
+        types (list): type of each column, see convert_column. If not
+            supplied, metrics are numbers and attributes text
+        total_rows (int): number of rows of the whole report, as returned
+            by the server, or None if unknown
+
+    Attributes:
+        headers (tuple): Attribute/Metric objects for the columns
+        types (tuple): type of each column
+        total_rows (int): number of rows of the whole report, or None
+    """
+    __slots__ = ('headers', 'types', 'total_rows', '_values')
+
+    def __init__(self, headers, values, types=None, total_rows=None):
+        self.headers = tuple(headers)
+        if types is None:
+            types = ['number' if isinstance(h, Metric) else 'text'
+                for h in self.headers]
+        self.types = tuple(types)
+        self.total_rows = total_rows
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def __repr__(self):
+        return "<ReportResult: columns:%s rows:%s>" % (len(self.headers),
+            len(self._values))
+
+    def get_headers(self):
+        """Returns the list of Attribute/Metric objects for the columns.
+        """
+        return list(self.headers)
+
+    def get_attributes(self):
+        """Returns the Attribute objects for the columns.
+        """
+        return [h for h in self.headers if isinstance(h, Attribute)]
+
+    def get_metrics(self):
+        """Returns the Metric objects for the columns.
+        """
+        return [h for h in self.headers if isinstance(h, Metric)]
+
+    def get_values(self):
+        """Returns the rows, as lists of (Attribute/Metric, value) tuples.
+        """
+        return self._values
+
+    def get_columns(self):
+        """Returns the values column by column, as a list of lists.
+        """
+        if not self._values:
+            return [[] for h in self.headers]
+        return [list(column) for column in
+            zip(*[[value for header, value in row] for row in self._values])]
+
+    def convert(self):
+        """Returns a new result with the values converted from strings
+        according to the type of their column.
+
+        Each column is converted in one batch, see convert_column. Metrics
+        become floats, and attributes are converted according to the type
+        of their form, e.g. datetime.date objects for date forms.
+        """
+        columns = [convert_column(column, column_type) for column, column_type
+            in zip(self.get_columns(), self.types)]
+        values = [zip(self.headers, row) for row in zip(*columns)]
+        return ReportResult(self.headers, values, self.types, self.total_rows)
+
+
+def convert_column(values, column_type):
+    """Converts the string values of a column to python values.
+
+    Each distinct value is converted once, and number columns are converted
+    in a single call when numpy is installed. Empty cells become None, and
+    values that cannot be converted are kept as strings.
+
+    Args:
+        values (list): the values of the column, as strings or None
+        column_type (str): one of 'number' (float), 'decimal' (Decimal),
+            'datetime', 'date', 'time' or 'text'. Dates and times are
+            parsed with the DATETIME_FORMATS, DATE_FORMATS or TIME_FORMATS
+
+    Returns:
+        list: the converted values
+    """
+    if column_type == 'number' and numpy is not None:
+        try:
+            numbers = numpy.array([v or 'nan' for v in values],
+                dtype=numpy.float64).tolist()
+        except ValueError:
+            pass
+        else:
+            return [n if v else None for v, n in zip(values, numbers)]
+    convert = _CONVERTERS.get(column_type)
+    memo = {None: None, '': None}
+    result = []
+    for value in values:
+        try:
+            result.append(memo[value])
+        except KeyError:
+            converted = memo[value] = convert(value) if convert else value
+            result.append(converted)
+    return result
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _to_decimal(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return value
+
+
+def _parse_datetime(value, formats):
+    for date_format in formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+
+def _to_datetime(value):
+    return _parse_datetime(value, DATETIME_FORMATS) or value
+
+
+def _to_date(value):
+    parsed = _parse_datetime(value, DATE_FORMATS)
+    return parsed.date() if parsed else value
+
+
+def _to_time(value):
+    parsed = _parse_datetime(value, TIME_FORMATS)
+    return parsed.time() if parsed else value
+
+
+_CONVERTERS = {
+    'number': _to_float,
+    'decimal': _to_decimal,
+    'datetime': _to_datetime,
+    'date': _to_date,
+    'time': _to_time
+}
+
+
+class ReportExecution(object):
+    """Handle on a report executing on the server, returned by
+    Report.submit.
+
+    The results are requested with getReportResults using the msgID of the
+    execution, until the server returns them. Once complete, the result is
+    also recorded on the report as if it had been executed.
+
+    Attributes:
+        message_id (str): msgID of the execution, or None if the results
+            were returned when the report was submitted
+        result (ReportResult): the results, or None until the execution
+            has completed
+    """
+    def __init__(self, report, window, response=None, message_id=None,
+            record=True):
+        self._report = report
+        self._window = window
+        self._record = record
+        self.message_id = message_id
+        self.result = None
+        if response is not None or message_id is None:
+            self._update(response)
+
+    def __repr__(self):
+        return "<ReportExecution: report:%s msgID:%s done:%s>" % (
+            self._report._id, self.message_id, self.done())
+
+    def done(self):
+        """Returns True if the execution has completed.
+        """
+        return self.result is not None
+
+    def poll(self):
+        """Checks once whether the execution has completed, without
+        waiting on the server.
+
+        Returns:
+            bool: True if the execution has completed
+
+        Raises:
+            MstrReportException: if there was an error executing the report.
+        """
+        if self.result is None:
+            arguments = {
+                'taskId': 'getReportResults',
+                'msgID': self.message_id,
+                'maxWait': 0,
+                'sessionState': self._report._mstr_client._session
+            }
+            arguments.update(self._window)
+            self._update(self._report._mstr_client._request(arguments))
+        return self.result is not None
+
+    def wait(self, timeout=None, interval=0.5, max_interval=10):
+        """Polls the execution until it completes, doubling the time
+        between two polls up to max_interval seconds.
 
         Args:
-            d (pyquery): a pyquery object
+            timeout (float): maximum number of seconds to wait
+            interval (float): seconds to wait before the second poll
+            max_interval (float): maximum number of seconds between polls
 
         Returns:
-            bool: indicates whether or not there was an error.
-            If there was an error, an exception should be raised.
+            ReportResult: the headers and rows of the execution
 
         Raises:
-            MstrReportException: if there was an error executing
-            the report.
-        """
-        error = d('error')
-        if error:
-            raise MstrReportException("There was an error running the report." +
-                "Microstrategy error message: " + error[0].text)
-            return True
-        return False          
-    
-    def _get_headers(self, d):
-        obj = d('objects')
-        headers = d('headers')
-        for col in headers.children():
-            elem = obj("[rfd='" + col.attrib['rfd'] + "']")
-            if elem('attribute'):
-                attr = Attribute(elem.attr('id'), elem.attr('name'))
-                self._attributes.append(attr)
-                self._headers.append(attr)
-            else:
-                metric = Metric(elem.attr('id'), elem.attr('name'))
-                self._metrics.append(metric)
-                self._headers.append(metric)
+            MstrReportException: if there was an error executing the
+                report, or it did not complete within the timeout.
+        """
+        return wait_all([self], timeout, interval, max_interval)[0]
+
+    def _update(self, response):
+        if self._pending(response):
+            return
+        result = self._report._parse_report(response)
+        if self._record:
+            result = self._report._record(result)
+        self.result = result
+
+    def _pending(self, response):
+        """Returns True if the response only holds the message of an
+        execution still running, storing its msgID.
+
+        Raises:
+            MstrReportException: if the report is waiting for prompt
+                answers.
+        """
+        if not response:
+            return False
+        if isinstance(response, unicode):
+            response = response.encode('utf-8')
+        root = etree.fromstring(response)
+        message = root.find('.//msg')
+        if (message is None or root.find('.//raw_data') is not None or
+                root.find('.//error') is not None):
+            return False
+        # status 2 means the report is waiting for prompt answers
+        if message.findtext('status') == '2':
+            raise MstrReportException("Report %s requires prompt "
+                "answers." % self._report._id)
+        self.message_id = message.findtext('id') or self.message_id
+        return True
+
+
+def wait_all(executions, timeout=None, interval=0.5, max_interval=10):
+    """Waits for several report executions to complete.
+
+    Every pending execution is polled in turn, then the time before the
+    next round of polls is doubled, up to max_interval seconds.
+
+    Args:
+        executions (list): ReportExecution objects returned by
+            Report.submit
+        timeout (float): maximum number of seconds to wait
+        interval (float): seconds to wait before the second round of polls
+        max_interval (float): maximum number of seconds between rounds
+
+    Returns:
+        list: the ReportResult of each execution, in the same order
+
+    Raises:
+        MstrReportException: if there was an error executing one of the
+            reports, or they did not all complete within the timeout.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    pending = list(executions)
+    while True:
+        pending = [e for e in pending if not e.poll()]
+        if not pending:
+            return [e.result for e in executions]
+        delay = interval
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise MstrReportException("Timed out waiting for %s report "
+                    "executions." % len(pending))
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        interval = min(interval * 2, max_interval)
+
+
+class JobResult(object):
+    """Outcome of a report execution run by MstrClient.execute_many.
+
+    Attributes:
+        job (dict): the job as it was passed to execute_many
+        result (ReportResult): headers and rows of the execution, or None
+            if the job failed
+        error (Exception): exception raised by the last attempt, or None
+            if the job succeeded
+        attempts (int): number of times the report was executed
+        elapsed (float): seconds spent on the job, including retries
+    """
+    __slots__ = ('job', 'result', 'error', 'attempts', 'elapsed')
+
+    def __init__(self, job, result, error, attempts, elapsed):
+        self.job = job
+        self.result = result
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return "<JobResult: report:%s attempts:%s elapsed:%.3f error:%r>" % (
+            self.job.get('report_id'), self.attempts, self.elapsed,
+            self.error)
+
+
+class _ReportStream(object):
+    """Parser for the ReportDataVisualizationXMLStyle output of
+    reportExecute.
+
+    Iterating yields the list of cell values of each <r> element as soon
+    as it is closed. Parsed elements are freed as the parser advances, so
+    memory use does not grow with the number of rows. Header objects are
+    looked up through a dictionary indexed on their rfd attribute.
+
+    Args:
+        source: a file-like object over the xml response
+
+    Attributes:
+        headers (list): Attribute/Metric objects for the columns, set once
+            the <headers> element has been parsed
+        types (list): type of each column, see convert_column, set with
+            the headers
+        total_rows (int): number of rows of the whole report, from the cn
+            attribute of <rows>, or None if the server did not return it
+    """
+    _tags = ('error', 'objects', 'headers', 'rows', 'r')
+
+    def __init__(self, source):
+        self._source = source
+        self._objects = {}
+        self.headers = None
+        self.types = None
+        self.total_rows = None
+
+    def __iter__(self):
+        for event, elem in etree.iterparse(self._source, tag=self._tags):
+            values = self._read(elem)
+            if values is not None:
+                yield values
+                self._release(elem)
+
+    @classmethod
+    def parse(cls, data):
+        """Parses a complete response in a single pass over the tree.
+
+        Args:
+            data (str): the xml response
+
+        Returns:
+            tuple: the list of headers, the list of column types, the list
+                of the cell values of each row and the total row count
+        """
+        stream = cls(None)
+        values = []
+        for elem in etree.fromstring(data).iter(*cls._tags):
+            row = stream._read(elem)
+            if row is not None:
+                values.append(row)
+        return stream.headers, stream.types, values, stream.total_rows
+
+    def _read(self, elem):
+        tag = elem.tag
+        if tag == 'r':
+            return [val.text for val in elem]
+        if tag == 'rows':
+            count = elem.get('cn')
+            if count and count.isdigit():
+                self.total_rows = int(count)
+        elif tag == 'objects':
+            for obj in elem:
+                self._objects[obj.get('rfd')] = obj
+        elif tag == 'headers':
+            objects = [self._objects[col.get('rfd')] for col in elem]
+            self.headers = [self._header(obj) for obj in objects]
+            self.types = [self._type(obj) for obj in objects]
+            self._objects.clear()
+        elif tag == 'error':
+            raise MstrReportException("There was an error running the " +
+                "report. Microstrategy error message: " + elem.text)
+
+    def _header(self, elem):
+        if elem.tag == 'attribute':
+            return Attribute(elem.get('id'), elem.get('name'))
+        return Metric(elem.get('id'), elem.get('name'))
+
+    def _type(self, elem):
+        if elem.tag != 'attribute':
+            return 'number'
+        form = elem.find('form')
+        if form is None:
+            return 'text'
+        return FORM_TYPES.get(form.get('base_form_type'), 'text')
+
+    def _release(self, elem):
+        elem.clear()
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def _read_columns(source):
+    """Parses a reportExecute response into a ReportColumns.
+
+    Module level so that it can be run by the processes of a parse pool.
+
+    Args:
+        source: a file-like object over the xml response, or the response
+            itself as a str
+    """
+    if isinstance(source, str):
+        source = io.BytesIO(source)
+    stream = _ReportStream(source)
+    columns = None
+    for values in stream:
+        if columns is None:
+            columns = ReportColumns(stream.headers)
+        columns.append(values)
+    if columns is None:
+        columns = ReportColumns(stream.headers or [])
+    return columns
+
+
+class ReportColumns(object):
+    """Column oriented values of an executed report.
+
+    Each column is stored in a typed array rather than as one string per
+    cell. Metric columns are arrays of doubles, with NaN for empty cells.
+    Attribute columns are dictionary encoded: an array of integer codes
+    indexing the list of distinct values of the column, -1 marking an
+    empty cell.
+
+    Args:
+        headers (list): Attribute/Metric objects for the columns
+
+    Attributes:
+        headers (list): Attribute/Metric objects for the columns
+        columns (list): a MetricColumn or AttributeColumn per header
+    """
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.columns = [AttributeColumn() if isinstance(h, Attribute)
+            else MetricColumn() for h in self.headers]
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        return self.columns[index]
+
+    def __repr__(self):
+        return "<ReportColumns: columns:%s rows:%s>" % (len(self.columns),
+            len(self))
+
+    def __getstate__(self):
+        # headers are rebuilt through their constructors, which share the
+        # objects with the same guid
+        return ([(isinstance(h, Attribute), h.guid, h.name)
+            for h in self.headers], self.columns)
+
+    def __setstate__(self, state):
+        headers, self.columns = state
+        self.headers = [Attribute(guid, name) if attribute
+            else Metric(guid, name) for attribute, guid, name in headers]
+
+    def append(self, values):
+        """Appends a row.
+
+        Args:
+            values (list): the cell values of the row, as strings
+        """
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def to_dataframe(self):
+        """Returns the values as a pandas DataFrame, with float columns
+        for the metrics and categorical columns for the attributes.
+
+        Raises:
+            MstrReportException: if pandas is not installed
+        """
+        if pandas is None:
+            raise MstrReportException("pandas must be installed to build a " +
+                "DataFrame")
+        data = {}
+        for index, column in enumerate(self.columns):
+            data[index] = column.to_series()
+        frame = pandas.DataFrame(data, columns=range(len(self.columns)))
+        frame.columns = [h.name for h in self.headers]
+        return frame
+
+
+class MetricColumn(object):
+    """Values of a metric column, stored as an array of doubles.
+
+    Attributes:
+        values (array): the values of the column, NaN for empty cells and
+            for values which are not numbers
+        invalid (dict): maps the index of each value which is not a number,
+            e.g. '1,234.5', to the value as returned by the server
+    """
+    def __init__(self):
+        self.values = array('d')
+        self.invalid = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    # arrays are pickled as lists of numbers, their buffer is much smaller
+
+    def __getstate__(self):
+        return self.values.tostring(), self.invalid
+
+    def __setstate__(self, state):
+        values, self.invalid = state
+        self.values = array('d')
+        self.values.fromstring(values)
+
+    def append(self, value):
+        if not value:
+            self.values.append(float('nan'))
+            return
+        try:
+            self.values.append(float(value))
+        except ValueError:
+            self.invalid[len(self.values)] = value
+            self.values.append(float('nan'))
+
+    def to_series(self):
+        return pandas.Series(numpy.frombuffer(self.values, dtype=numpy.float64))
+
+
+class AttributeColumn(object):
+    """Values of an attribute column, stored dictionary encoded.
+
+    Attributes:
+        codes (array): for each row, the index of its value in categories,
+            -1 for empty cells
+        categories (list): the distinct values of the column
+    """
+    def __init__(self):
+        self.codes = array('l')
+        self.categories = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        if code < 0:
+            return None
+        return self.categories[code]
+
+    def __getstate__(self):
+        return self.codes.tostring(), self.categories
+
+    def __setstate__(self, state):
+        codes, self.categories = state
+        self.codes = array('l')
+        self.codes.fromstring(codes)
+        self._index = dict([(value, code)
+            for code, value in enumerate(self.categories)])
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.categories)
+            self.categories.append(value)
+        self.codes.append(code)
+
+    def to_series(self):
+        codes = numpy.frombuffer(self.codes, dtype=numpy.int_)
+        return pandas.Series(pandas.Categorical.from_codes(codes,
+            self.categories))
+
+
+class _CsvWriter(object):
+    """Writes report results to a csv file, utf-8 encoded, with a first
+    line holding the names of the headers.
+    """
+    def __init__(self, path, headers):
+        self._file = open(path, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self._encode([h.name for h in headers]))
+
+    def write(self, result):
+        for row in result:
+            self._writer.writerow(self._encode([value for header, value
+                in row]))
+
+    def close(self):
+        self._file.close()
+
+    def _encode(self, values):
+        return [v.encode('utf-8') if isinstance(v, unicode) else v
+            for v in values]
+
+
+class _ArrowWriter(object):
+    """Writes report results to a parquet or arrow file, each result being
+    written as a row group or record batch.
+    """
+    def __init__(self, path, headers, types, format):
+        self._types = [t if t != 'decimal' else 'text' for t in types]
+        self._schema = pyarrow.schema([pyarrow.field(h.name,
+            self._arrow_type(t)) for h, t in zip(headers, self._types)])
+        self._parquet = format == 'parquet'
+        self._sink = None
+        if self._parquet:
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._sink = pyarrow.OSFile(path, 'wb')
+            self._writer = pyarrow.RecordBatchFileWriter(self._sink,
+                self._schema)
+
+    def write(self, result):
+        arrays = []
+        for column, column_type, field in zip(result.get_columns(),
+                self._types, self._schema):
+            values = self._typed_values(column, column_type, field.name)
+            arrays.append(pyarrow.array(values, type=field.type))
+        batch = pyarrow.RecordBatch.from_arrays(arrays, self._schema.names)
+        if self._parquet:
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    @classmethod
+    def _typed_values(cls, column, column_type, name):
+        """Converts the values of a column to its type, the values which
+        cannot be converted becoming None.
+        """
+        values = convert_column(column, column_type)
+        if column_type == 'text':
+            return values
+        # values which could not be converted are kept as strings, which
+        # the typed column cannot hold
+        invalid = [v for v in values if isinstance(v, basestring)]
+        if not invalid:
+            return values
+        logger.warning("writing %s values of column %s which are not of "
+            "type %s as null, e.g. %r", len(invalid), name, column_type,
+            invalid[0])
+        return [None if isinstance(v, basestring) else v for v in values]
+
+    def _arrow_type(self, column_type):
+        if column_type == 'number':
+            return pyarrow.float64()
+        if column_type == 'datetime':
+            return pyarrow.timestamp('s')
+        if column_type == 'date':
+            return pyarrow.date32()
+        if column_type == 'time':
+            return pyarrow.time32('s')
+        return pyarrow.string()
+
+
+class AsyncMstrClient(object):
+    """Non-blocking counterpart of MstrClient.
+
+    Wraps a logged in MstrClient and runs its tasks on a bounded pool of
+    worker threads, all sharing the client's session. Every method returns
+    immediately with a multiprocessing.pool.AsyncResult, whose get() returns
+    what the matching MstrClient method returns. At most concurrency
+    requests are in flight at once; the wrapped client should be created
+    with a pool_maxsize of at least that many connections.
+
+    Args:
+        mstr_client (MstrClient): logged in client used for the requests
+        concurrency (int): maximum number of concurrent requests
+    """
+    def __init__(self, mstr_client, concurrency=10):
+        self._mstr_client = mstr_client
+        self._pool = ThreadPool(concurrency)
+
+    def __str__(self):
+        return 'AsyncMstrClient for %s' % self._mstr_client
+
+    def close(self):
+        """Waits for the pending tasks to complete and stops the workers.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def get_report(self, report_id):
+        """Returns an AsyncReport object. No request is made.
+
+        Args:
+            report_id (str): report guid for the report
+        """
+        return AsyncReport(self, report_id)
+
+    def get_folder_contents(self, folder_id=None):
+        """See MstrClient.get_folder_contents
+
+        Returns:
+            AsyncResult: result of the folder listing
+        """
+        return self._pool.apply_async(self._mstr_client.get_folder_contents,
+            (folder_id,))
+
+    def list_elements(self, attribute_id, block_size=None):
+        """See MstrClient.list_elements
+
+        Returns:
+            AsyncResult: result of the element listing
+        """
+        return self._pool.apply_async(self._mstr_client.list_elements,
+            (attribute_id, block_size, 1))
+
+    def get_attribute(self, attribute_id):
+        """See MstrClient.get_attribute
+
+        Returns:
+            AsyncResult: result of the attribute lookup
+        """
+        return self._pool.apply_async(self._mstr_client.get_attribute,
+            (attribute_id,))
+
+
+class AsyncReport(object):
+    """Non-blocking counterpart of Report, created by AsyncMstrClient.
+
+    The calls share one Report object, so the execution started by
+    get_prompts is answered by the next prompted execution. Any number of
+    executions of the report may be pending at once, each returning its
+    own ReportResult.
+
+    Args:
+        async_client (AsyncMstrClient): client whose workers run the tasks
+        report_id (str): report guid
+    """
+    def __init__(self, async_client, report_id):
+        self._async_client = async_client
+        self._id = report_id
+        self._report = Report(async_client._mstr_client, report_id)
+
+    def __str__(self):
+        return 'AsyncReport with id %s' % self._id
+
+    def get_prompts(self):
+        """See Report.get_prompts
+
+        Returns:
+            AsyncResult: result holding the list of Prompt objects
+        """
+        return self._async_client._pool.apply_async(self._report.get_prompts)
+
+    def execute(self, *args, **kwargs):
+        """Executes the report with the arguments of Report.execute
+
+        Returns:
+            AsyncResult: result holding the ReportResult of the execution
+        """
+        return self._async_client._pool.apply_async(self._report.execute,
+            args, kwargs)
+
 
 class MstrClientException(Exception):
     """Class used to raise errors in the MstrClient class
     """
     def __init__(self, msg):
+        Exception.__init__(self, msg)
         self.msg = msg
 
     def __str__(self):
         return self.msg
 
+class MstrRequestException(MstrClientException):
+    """Raised when the Task Service returns an error status.
+
+    Attributes:
+        status (int): the http status of the response
+        code (str): the error code returned by the Task Service, if any
+        retriable (bool): whether the request may succeed if retried
+        session_expired (bool): whether the session is no longer valid
+    """
+    def __init__(self, msg, status=None, code=None, retriable=False,
+            session_expired=False):
+        MstrClientException.__init__(self, msg)
+        self.status = status
+        self.code = code
+        self.retriable = retriable
+        self.session_expired = session_expired
+
 class MstrReportException(Exception):
     """Class used to raise errors in the MstrReport class
     """
     def __init__(self, msg):
+        Exception.__init__(self, msg)
         self.msg = msg
 
     def __str__(self):
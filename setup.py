@@ -16,6 +16,7 @@ setup(
     author_email='oss@infoscoutinc.com',
     license='MIT',
     install_requires=[
+        'lxml>=3.0',
         'pyquery==1.2.8',
         'requests==2.3.0',
     ],
@@ -1,25 +1,81 @@
 
 from py_mstr import MstrClient, Singleton, Attribute, Metric, Prompt, \
-    Report, MstrClientException, MstrReportException
-
+    Report, MstrClientException, MstrReportException, AsyncMstrClient, \
+    MstrSessionPool, MemoryCache, SqliteCache, ReportResult, \
+    wait_all, convert_column, MetricsCollector, Histogram, RetryPolicy, \
+    CircuitBreaker, MstrRequestException
+
+import datetime
+import gc
+import io
+import logging
+import multiprocessing
+import os
+import requests
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 import mox
 import stubout
+import py_mstr.py_mstr
+
+from requests.packages.urllib3.response import HTTPResponse
+
+
+def serialize_calls(obj, name):
+    """ Mox mocks are not thread safe, so the calls made to a mocked method
+        from worker threads are serialized.
+    """
+    mock = getattr(obj, name)
+    lock = threading.Lock()
+    def call(*args, **kwargs):
+        with lock:
+            return mock(*args, **kwargs)
+    setattr(obj, name, call)
 
 class MstrClientTestCase(mox.MoxTestBase):
 
     def setUp(self):
         mox.MoxTestBase.setUp(self)
-        s = stubout.StubOutForTesting()
-        s.Set(MstrClient, '_login', lambda self, source, name, username,
-            password: None)
+        self.stubs.Set(MstrClient, '_login', lambda self, source, name,
+            username, password: None)
         self.client = MstrClient('url?', 'username', 'pw', 'source', 'name')
+        # test_init logs in through the real _login
+        self.stubs.UnsetAll()
         self.client._session = 'session'
         self.mox.StubOutWithMock(self.client, "_request")
 
     def tearDown(self):
+        self.stubs.UnsetAll()
         mox.MoxTestBase.tearDown(self)
 
+    def _client(self, **kwargs):
+        """Returns a client logged in with the session 'session', which
+        does not log out, for the tests of its requests.
+        """
+        self.stubs.Set(MstrClient, '_login', lambda self, source, name,
+            username, password: 'session')
+        client = MstrClient('url?', 'username', 'pw', 'source', 'name',
+            **kwargs)
+        client._logout = lambda: None
+        return client
+
+    def _response(self, status_code=200, headers=None,
+            content='<response/>'):
+        class Response(object):
+            elapsed = datetime.timedelta(seconds=0.5)
+            reason = 'Error'
+            raw = io.BytesIO()
+            def close(self):
+                pass
+        response = Response()
+        response.status_code = status_code
+        response.headers = headers or {}
+        response.text = response.content = content
+        return response
+
     def test_init(self):
         """ Test the format of retrieving the session when logging in.
             Requires creating a separate client object in order to test _login
@@ -47,6 +103,288 @@ class MstrClientTestCase(mox.MoxTestBase):
         self.assertEqual('session', client._session)
         self.assertEqual('url?', client._base_url)
 
+    def test_request_uses_session(self):
+        """ Test requests go through the client's http session, using the
+            timeout configured for the task.
+        """
+
+        client = self._client(timeout=5, task_timeouts={'reportExecute': 600})
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('taskId=reportExecute'), stream=False,
+            timeout=600).AndReturn(self._response())
+        client._http.get(mox.StrContains('taskID=folderBrowse'), stream=False,
+            timeout=5).AndReturn(self._response())
+
+        self.mox.ReplayAll()
+
+        self.assertEqual('<response/>',
+            client._request({'taskId': 'reportExecute'}))
+        self.assertEqual('<response/>',
+            client._request({'taskID': 'folderBrowse'}))
+
+    def test_request_does_not_modify_arguments(self):
+        """ Test the arguments passed to a request are left untouched, so
+            they can be shared between threads.
+        """
+
+        client = self._client()
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('taskId=reportExecute'), stream=False,
+            timeout=None).AndReturn(self._response())
+
+        self.mox.ReplayAll()
+
+        arguments = {'taskId': 'reportExecute'}
+        client._request(arguments)
+        self.assertEqual({'taskId': 'reportExecute'}, arguments)
+
+    def test_request_metrics(self):
+        """ Test the hooks are notified of each request and of the parsing
+            of report executions, and that passwords are not logged.
+        """
+
+        response = self._response(content="<response><objects><metric " +
+            "rfd='0' id='m' name='m'/></objects><raw_data><headers><oi " +
+            "rfd='0'/></headers><rows><r><v>1</v></r><r><v>2</v></r>" +
+            "</rows></raw_data></response>")
+
+        class Handler(logging.Handler):
+            messages = []
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        metrics = MetricsCollector()
+        client = self._client(hooks=[metrics])
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('password=secret'), stream=False,
+            timeout=None).AndRaise(requests.exceptions.Timeout('timed out'))
+        client._http.get(mox.StrContains('taskId=reportExecute'),
+            stream=False, timeout=None).AndReturn(response)
+        self.mox.ReplayAll()
+
+        handler = Handler()
+        logger = logging.getLogger('py_mstr.py_mstr')
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            self.assertRaises(requests.exceptions.Timeout, client._request,
+                {'taskId': 'login', 'password': 'secret'})
+            client.get_report('report_id').execute()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertFalse([m for m in handler.messages if 'secret' in m])
+        self.assertEqual({'login': 1}, metrics.errors)
+        self.assertEqual(1, metrics.histogram('login', 'elapsed').count)
+        self.assertEqual(None, metrics.histogram('login', 'ttfb'))
+        self.assertEqual(0.5, metrics.histogram('reportExecute', 'ttfb').max)
+        self.assertEqual(len(response.content),
+            metrics.histogram('reportExecute', 'bytes_received').max)
+        summary = metrics.summary()
+        self.assertEqual(2, summary['reportExecute']['rows']['p50'])
+        self.assertEqual(1, summary['reportExecute']['parse']['count'])
+
+    def test_request_compressed_stream(self):
+        """ Test streamed responses are decompressed as they are read and
+            that both sizes of the body are reported once it is read.
+        """
+        body = '<response>' + '<r><v>1</v></r>' * 1000 + '</response>'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compressed = compressor.compress(body) + compressor.flush()
+
+        response = self._response()
+        response.raw = HTTPResponse(io.BytesIO(compressed),
+            headers={'content-encoding': 'gzip'}, preload_content=False)
+
+        metrics = MetricsCollector()
+        client = self._client(hooks=[metrics])
+        self.assertEqual('gzip, deflate',
+            client._http.headers['Accept-Encoding'])
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('taskId=reportExecute'), stream=True,
+            timeout=None).AndReturn(response)
+        self.mox.ReplayAll()
+
+        stream = client._request({'taskId': 'reportExecute'}, stream=True)
+        self.assertEqual(None, metrics.histogram('reportExecute', 'elapsed'))
+        data = ''.join(iter(lambda: stream.read(100), ''))
+        self.assertEqual(body, data)
+        self.assertEqual(len(body),
+            metrics.histogram('reportExecute', 'bytes_received').max)
+        self.assertEqual(len(compressed),
+            metrics.histogram('reportExecute', 'bytes_compressed').max)
+        self.assertEqual(1,
+            metrics.histogram('reportExecute', 'elapsed').count)
+
+    def test_request_retry(self):
+        """ Test transient failures are retried according to the policy and
+            that other errors are raised immediately.
+        """
+
+        client = self._client(retry_policy=RetryPolicy(retries=2, backoff=0))
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('taskID=folderBrowse'), stream=False,
+            timeout=None).AndReturn(self._response(503))
+        client._http.get(mox.StrContains('taskID=folderBrowse'), stream=False,
+            timeout=None).AndRaise(requests.exceptions.Timeout('timed out'))
+        client._http.get(mox.StrContains('taskID=folderBrowse'), stream=False,
+            timeout=None).AndReturn(self._response())
+        client._http.get(mox.StrContains('taskId=reportExecute'), stream=False,
+            timeout=None).AndReturn(self._response(500,
+            {'X-MSTR-TaskFailureMsg': 'Report not found'}))
+        self.mox.ReplayAll()
+
+        self.assertEqual('<response/>', client._request({'taskID':
+            'folderBrowse'}))
+        try:
+            client._request({'taskId': 'reportExecute'})
+            self.fail()
+        except MstrRequestException as e:
+            self.assertEqual(500, e.status)
+            self.assertFalse(e.retriable)
+
+    def test_session_expired(self):
+        """ Test the client logs in again when its session has expired, and
+            retries the request with the new session.
+        """
+
+        client = self._client()
+        client._login = lambda source, name, username, password: 'new_session'
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.StrContains('sessionState=session'), stream=False,
+            timeout=None).AndReturn(self._response(500,
+            {'X-MSTR-TaskErrorCode': '-2147468986'}))
+        client._http.get(mox.StrContains('sessionState=new_session'),
+            stream=False, timeout=None).AndReturn(self._response())
+        self.mox.ReplayAll()
+
+        report = client.get_report('report_id')
+        self.assertEqual('<response/>', client._request({'taskID':
+            'folderBrowse', 'sessionState': 'session'}))
+        self.assertEqual('new_session', client._session)
+        self.assertEqual('new_session', report._args['sessionState'])
+
+    def test_session_error_message(self):
+        """ Test only the known messages mark the session as expired when
+            no error code is returned.
+        """
+
+        client = self._client()
+        for message, expired in [('Session limit exceeded', False),
+                ('Session expired', True)]:
+            try:
+                client._check_status('folderBrowse', self._response(500,
+                    {'X-MSTR-TaskFailureMsg': message}))
+                self.fail()
+            except MstrRequestException as e:
+                self.assertEqual(expired, e.session_expired)
+
+    def test_request_returns_bytes(self):
+        """ Test the body is returned undecoded, so it is not copied before
+            being parsed.
+        """
+
+        client = self._client()
+        response = self._response(
+            content=u'<response>\u00e9</response>'.encode('utf-8'))
+        def text(response):
+            raise AssertionError("the body was decoded")
+        type(response).text = property(text)
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.IgnoreArg(), stream=False, timeout=None
+            ).AndReturn(response)
+        self.mox.ReplayAll()
+
+        self.assertEqual(response.content, client._request({'taskId':
+            'reportExecute'}))
+
+    def test_job_deadline(self):
+        """ Test requests are not sent once the job is out of time, and
+            that their timeout is shortened to the time left.
+        """
+
+        client = self._client(timeout=600)
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.IgnoreArg(), stream=False, timeout=mox.Func(
+            lambda timeout: 0 < timeout <= 10)).AndReturn(self._response())
+        self.mox.ReplayAll()
+
+        client._local.deadline = time.time() + 10
+        client._request({'taskId': 'reportExecute'})
+        client._local.deadline = time.time() - 1
+        self.assertRaises(requests.exceptions.Timeout, client._request,
+            {'taskId': 'reportExecute'})
+
+    def test_long_request_posted(self):
+        """ Test requests with a url longer than the maximum are sent as a
+            compressed POST body.
+        """
+
+        import urlparse
+        import zlib
+        def body(data):
+            params = dict(urlparse.parse_qsl(zlib.decompress(data, 31)))
+            return params['elementsPromptAnswers'] == ','.join(values) and \
+                params['taskId'] == 'reportExecute'
+
+        client = self._client(max_url_length=100, compress_requests=True)
+        values = ['attr_id;attr_id:%s' % i for i in range(100)]
+        self.mox.StubOutWithMock(client._http, 'post')
+        client._http.post('url', data=mox.Func(body), headers={'Content-Type':
+            'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'},
+            stream=False, timeout=None).AndReturn(self._response())
+        self.mox.ReplayAll()
+
+        self.assertEqual('<response/>', client._request({'taskId':
+            'reportExecute', 'elementsPromptAnswers': ','.join(values)}))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record(False)
+        breaker.before_request()
+        breaker.record(False)
+        self.assertEqual('open', breaker.state())
+        self.assertRaises(MstrClientException, breaker.before_request)
+        breaker._reset_timeout = 0
+        self.assertEqual('half-open', breaker.state())
+        breaker.before_request()
+        self.assertRaises(MstrClientException, breaker.before_request)
+        breaker.record(True)
+        self.assertEqual('closed', breaker.state())
+
+    def test_circuit_breaker_trial_error(self):
+        """ Test a trial request failing with an unexpected error opens
+            the breaker again instead of leaving it stuck.
+        """
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        client = self._client(circuit_breaker=breaker)
+        breaker.record(False)
+        self.mox.StubOutWithMock(client._http, 'get')
+        client._http.get(mox.IgnoreArg(), stream=False, timeout=None
+            ).AndRaise(requests.exceptions.ContentDecodingError('gzip'))
+        client._http.get(mox.IgnoreArg(), stream=False, timeout=None
+            ).AndReturn(self._response())
+        self.mox.ReplayAll()
+
+        self.assertRaises(requests.exceptions.ContentDecodingError,
+            client._request, {'taskId': 'reportExecute'})
+        self.assertEqual('half-open', breaker.state())
+        client._request({'taskId': 'reportExecute'})
+        self.assertEqual('closed', breaker.state())
+
+    def test_histogram(self):
+        histogram = Histogram(start=1, factor=2, buckets=4)
+        for value in [0.5, 1, 3, 3, 7, 100]:
+            histogram.add(value)
+        self.assertEqual([2, 0, 2, 1, 1], histogram.counts)
+        self.assertEqual(1, histogram.percentile(20))
+        self.assertEqual(4, histogram.percentile(50))
+        self.assertEqual(100, histogram.percentile(99))
+        self.assertEqual(114.5 / 6, histogram.mean())
+
     def test_folder_contents(self):
         """ Test folder contents are correctly parsed when either a parent 
             folder is supplied or is not
@@ -86,6 +424,68 @@ class MstrClientTestCase(mox.MoxTestBase):
         self.assertEqual({'name': 'child folder', 'description': 'description',
             'id': 'child id', 'type': '8'}, child_folder[0])
 
+    def test_walk_folders(self):
+        """ Test the folder tree is walked breadth first, filtering on the
+            object types and browsing each folder once.
+        """
+
+        def folder(folder_id, objects):
+            args = {'sessionState': 'session', 'taskID': 'folderBrowse'}
+            if folder_id:
+                args['folderID'] = folder_id
+            self.client._request(args).InAnyOrder().AndReturn(
+                "<response><folders>" + ''.join([("<obj><n>%s</n><d/><id>%s" +
+                "</id><t>%s</t></obj>") % (o, o, t) for o, t in objects]) +
+                "</folders></response>")
+
+        folder(None, [('a', 8), ('b', 8), ('r1', 3)])
+        folder('a', [('c', 8), ('r2', 3)])
+        folder('b', [('a', 8), ('r3', 3)])
+        folder('c', [('r4', 3)])
+
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        found = dict([(obj['id'], path) for path, obj in
+            self.client.walk_folders(concurrency=2, types=[3])])
+        self.assertEqual({'r1': (), 'r2': ('a',), 'r3': ('b',),
+            'r4': ('a', 'c')}, found)
+
+    def test_walk_folders_closed(self):
+        """ Test closing the generator stops browsing the queued folders.
+        """
+
+        browsed = []
+        def request(arguments):
+            folder_id = arguments.get('folderID', 'root')
+            browsed.append(folder_id)
+            time.sleep(0.05)
+            if folder_id != 'root':
+                return "<response><folders><obj><n>r</n><d/><id>r</id>" \
+                    "<t>3</t></obj></folders></response>"
+            return "<response><folders>" + ''.join(["<obj><n>f%s</n><d/>" \
+                "<id>f%s</id><t>8</t></obj>" % (i, i) for i in range(10)]) + \
+                "</folders></response>"
+        self.client._request = request
+
+        objects = self.client.walk_folders(concurrency=1)
+        for i in range(11):
+            objects.next()
+        objects.close()
+        self.assertTrue(len(browsed) <= 4)
+
+    def test_walk_folders_max_depth(self):
+        self.client._request({'sessionState': 'session', 'taskID':
+            'folderBrowse', 'folderID': 'root'}).AndReturn("<response>" +
+            "<folders><obj><n>a</n><d/><id>a</id><t>8</t></obj></folders>" +
+            "</response>")
+
+        self.mox.ReplayAll()
+
+        found = list(self.client.walk_folders('root', max_depth=1))
+        self.assertEqual(1, len(found))
+        self.assertEqual(((), 'a'), (found[0][0], found[0][1]['id']))
+
     def test_list_elements(self):
         """ Test correct values are retrieved when retrieving all the values that
             an attribute can take.
@@ -108,6 +508,84 @@ class MstrClientTestCase(mox.MoxTestBase):
         self.assertEqual(2, len(values))
         self.assertEqual('valid1', values[0])
 
+    def _element_block(self, attribute_id, names, total):
+        return "<response><root><items>" + ''.join(["<block><dssid>%s:%s" \
+            "</dssid><n>%s</n></block>" % (attribute_id, n, n) for n in names]) +\
+            "</items><totalSize>%s</totalSize></root></response>" % total
+
+    def test_iter_elements(self):
+        """ Test the elements of an attribute are retrieved in blocks and
+            yielded in order.
+        """
+
+        for begin, names in [(1, ['v1', 'v2']), (3, ['v3', 'v4']),
+                (5, ['v5'])]:
+            args = {
+                'taskId': 'browseElements',
+                'attributeID': 'attr_id',
+                'sessionState': 'session',
+                'blockBegin': begin,
+                'blockCount': 2
+            }
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._element_block('attr_id', names, 5))
+
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        self.assertEqual(['v1', 'v2', 'v3', 'v4', 'v5'],
+            self.client.list_elements('attr_id', block_size=2, concurrency=2))
+
+    def test_iter_elements_without_total(self):
+        """ Test blocks are requested until one is short when the server
+            does not return the total number of elements.
+        """
+
+        blocks = {1: ['v1', 'v2'], 3: ['v3', 'v4'], 5: ['v5']}
+        def request(arguments):
+            return self._element_block('attr_id',
+                blocks.get(arguments['blockBegin'], []), '')
+        self.client._request = request
+
+        self.assertEqual(['v1', 'v2', 'v3', 'v4', 'v5'],
+            self.client.list_elements('attr_id', block_size=2, concurrency=2))
+
+    def test_iter_elements_closed(self):
+        """ Test blocks are requested at most concurrency blocks ahead and
+            that closing the generator stops requesting them.
+        """
+
+        requested = []
+        def request(arguments):
+            requested.append(arguments['blockBegin'])
+            begin = arguments['blockBegin']
+            return self._element_block('attr_id', ['v%s' % begin,
+                'v%s' % (begin + 1)], 100)
+        self.client._request = request
+
+        elements = self.client.iter_elements('attr_id', block_size=2,
+            concurrency=2)
+        self.assertEqual(['v1', 'v2', 'v3'],
+            [elements.next() for i in range(3)])
+        elements.close()
+        self.assertTrue(len(requested) <= 4)
+
+    def test_list_elements_many(self):
+        for attribute_id in ('attr1', 'attr2'):
+            args = {
+                'taskId': 'browseElements',
+                'attributeID': attribute_id,
+                'sessionState': 'session'
+            }
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._element_block(attribute_id, [attribute_id + '_v'], 1))
+
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        self.assertEqual({'attr1': ['attr1_v'], 'attr2': ['attr2_v']},
+            self.client.list_elements_many(['attr1', 'attr2']))
+
     def test_get_attribute(self):
         """ Test retrieving information about an attribute returns a proper
             Attribute object.
@@ -131,6 +609,30 @@ class MstrClientTestCase(mox.MoxTestBase):
         self.assertEqual('attr_id', attr.guid)
         self.assertEqual('attr_name', attr.name)
 
+    def test_cached_metadata(self):
+        """ Test metadata is only requested once when the client has a cache,
+            until the cache is invalidated.
+        """
+
+        args = {
+            'taskId': 'browseElements',
+            'attributeID': 'attr_id',
+            'sessionState': 'session'
+        }
+        result = "<response><items><block><n>valid1</n></block></items>" +\
+            "</response>"
+        self.client._request(args).AndReturn(result)
+        self.client._request(args).AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        self.client._cache = MemoryCache()
+        self.assertEqual(['valid1'], self.client.list_elements('attr_id'))
+        self.assertEqual(['valid1'], self.client.list_elements('attr_id'))
+        self.assertEqual(1, self.client._cache.hits)
+        self.client.invalidate_cache('list_elements')
+        self.assertEqual(['valid1'], self.client.list_elements('attr_id'))
+
 
 class MstrReportTestCase(mox.MoxTestBase):
 
@@ -209,6 +711,68 @@ class MstrReportTestCase(mox.MoxTestBase):
         self.assertEqual('attr1_id', prompts[0].attribute.guid)
         self.assertEqual('msg1', prompts[0].prompt_str)
 
+    def test_prompted_execute_reuses_message(self):
+        """ Test the execution started by get_prompts is answered by the next
+            prompted execution, and that the prompts and headers are shared
+            with the other reports of the client.
+        """
+
+        import copy
+        self.client._request({'reportID': 'report_id', 'sessionState':
+            'session', 'taskId': 'reportExecute'}).AndReturn(
+            "<response><msg><id>msg_id</id></msg></response>")
+        self.client._request({'taskId': 'getPrompts', 'objectType': '3',
+            'msgID': 'msg_id', 'sessionState': 'session'}).AndReturn(
+            "<response><rsl><prompts><block><reqd>true</reqd><mn>msg1</mn>" +
+            "<orgn><did>attr1_id</did><n>attr1_name</n></orgn><loc><did>" +
+            "guid1</did></loc></block></prompts></rsl></response>")
+        self.client._request({'taskId': 'answerPrompts', 'objectType': '3',
+            'msgID': 'msg_id', 'sessionState': 'session',
+            'elementsPromptAnswers': 'attr1_id;attr1_id:v1'}).AndReturn(
+            "<response/>")
+        results_args = copy.deepcopy(self.report_args)
+        del results_args['reportID']
+        results_args.update({'taskId': 'getReportResults', 'msgID': 'msg_id',
+            'maxWait': 0})
+        self.client._request(results_args).AndReturn("<response><msg><id>" +
+            "msg_id</id><status>4</status></msg></response>")
+        self.client._request(results_args).AndReturn(self.report_response)
+        args = copy.deepcopy(self.report_args)
+        args['elementsPromptAnswers'] = 'attr1_id;attr1_id:v2'
+        self.client._request(args).AndReturn(self.report_response)
+        self.mox.ReplayAll()
+
+        prompt = self.report.get_prompts()[0]
+        self.assertEqual(2, len(self.report.execute(max_cols=10,
+            element_prompt_answers={prompt: ['v1']})))
+        self.assertEqual(2, len(self.report.execute(max_cols=10,
+            element_prompt_answers={prompt: ['v2']})))
+
+        report = self.client.get_report('report_id')
+        self.assertEqual([prompt], report.get_prompts())
+        self.assertEqual(2, len(report.get_headers()))
+        self.client.clear_report_definitions('report_id')
+        self.assertRaises(MstrReportException,
+            self.client.get_report('report_id').get_headers)
+
+    def test_prompted_execute_unanswered(self):
+        """ Test answers leaving the reused execution in prompt status raise
+            an error, and that nothing is stored in the result cache.
+        """
+
+        self.client._result_cache = MemoryCache()
+        self.report._message = ('msg_id', 'session')
+        self.client._request(mox.ContainsKeyValue('taskId', 'answerPrompts')
+            ).AndReturn("<response><msg><id>msg_id</id><status>2</status>" +
+            "</msg></response>")
+        self.mox.ReplayAll()
+
+        prompt = Prompt('p1guid', 'Prompt 1', True,
+            Attribute('attr1_id', 'attr1_name'))
+        self.assertRaises(MstrReportException, self.report.execute,
+            max_cols=10, element_prompt_answers={prompt: ['v1']})
+        self.assertEqual(0, len(self.client._result_cache))
+
     def test_get_attributes(self):
         """ Test getting the attributes (or headers) for a report returns
             valid Attribute/Metric objects. Also test that headers are saved
@@ -286,6 +850,549 @@ class MstrReportTestCase(mox.MoxTestBase):
         self.assertEqual([(attr1, 'col1_val2'), (attr2, 'col2_val2')],
             self.report._values[1])
 
+    def test_execute_result(self):
+        """ Test execute returns the headers and rows of the execution.
+        """
+
+        self.client._request(self.report_args).AndReturn(self.report_response)
+        self.mox.ReplayAll()
+
+        result = self.report.execute(max_cols=10)
+
+        self.assertTrue(isinstance(result, ReportResult))
+        self.assertEqual(2, len(result))
+        self.assertEqual(self.report.get_headers(), result.get_headers())
+        self.assertEqual(self.report.get_values(), result.get_values())
+        self.assertEqual([], result.get_metrics())
+        self.assertEqual('col2_val2', result[1][1][1])
+
+    def test_concurrent_execute(self):
+        """ Test a report executed from several threads returns the rows of
+            each execution.
+        """
+
+        import copy
+        from multiprocessing.pool import ThreadPool
+        for start in range(4):
+            args = copy.deepcopy(self.report_args)
+            args.update({'startRow': start, 'maxRows': 1})
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._page_response([start]))
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        pool = ThreadPool(4)
+        results = pool.map(lambda start: self.report.execute(start_row=start,
+            max_rows=1, max_cols=10), range(4))
+        pool.close()
+
+        self.assertEqual(['0', '1', '2', '3'],
+            [result[0][0][1] for result in results])
+        self.assertEqual(2, len(self.report.get_headers()))
+
+    def test_submit_execute(self):
+        """ Test a submitted report is polled with its msgID until the
+            results are returned.
+        """
+
+        import copy
+        submit_args = copy.deepcopy(self.report_args)
+        submit_args['maxWait'] = 0
+        poll_args = copy.deepcopy(self.report_args)
+        del poll_args['taskId'], poll_args['reportID']
+        poll_args.update({'taskId': 'getReportResults', 'msgID': 'msg_id',
+            'maxWait': 0})
+        pending = "<response><msg><id>msg_id</id><status>4</status></msg>" + \
+            "</response>"
+        self.client._request(submit_args).AndReturn(pending)
+        self.client._request(poll_args).AndReturn(pending)
+        self.client._request(poll_args).AndReturn(self.report_response)
+        self.mox.ReplayAll()
+
+        execution = self.report.submit(max_cols=10)
+        self.assertEqual('msg_id', execution.message_id)
+        self.assertFalse(execution.done())
+        result = execution.wait(interval=0)
+
+        self.assertTrue(execution.done())
+        self.assertEqual(2, len(result))
+        self.assertEqual(result.get_values(), self.report.get_values())
+
+    def test_wait_all(self):
+        """ Test several submitted reports are collected in order, polling
+            only the executions still pending.
+        """
+
+        import copy
+        for report_id, message_id in [('first_id', 'msg1'),
+                ('second_id', 'msg2')]:
+            args = copy.deepcopy(self.report_args)
+            args.update({'reportID': report_id, 'maxWait': 0})
+            self.client._request(args).AndReturn("<response><msg><id>%s</id>" %
+                message_id + "<status>4</status></msg></response>")
+        poll_args = copy.deepcopy(self.report_args)
+        del poll_args['taskId'], poll_args['reportID']
+        poll_args.update({'taskId': 'getReportResults', 'maxWait': 0})
+        poll_args['msgID'] = 'msg1'
+        self.client._request(poll_args).AndReturn("<response><msg><id>msg1" +
+            "</id><status>4</status></msg></response>")
+        self.client._request(dict(poll_args, msgID='msg2')).AndReturn(
+            self.report_response)
+        self.client._request(poll_args).AndReturn(self.report_response)
+        self.mox.ReplayAll()
+
+        first = Report(self.client, 'first_id').submit(max_cols=10)
+        second = Report(self.client, 'second_id').submit(max_cols=10)
+        results = wait_all([first, second], interval=0)
+        self.assertEqual(2, len(results))
+        self.assertEqual(first.result, results[0])
+        self.assertEqual(second.result, results[1])
+
+    def test_submit_prompted(self):
+        """ Test submitting a report waiting for prompt answers raises an
+            error.
+        """
+
+        import copy
+        args = copy.deepcopy(self.report_args)
+        args['maxWait'] = 0
+        self.client._request(args).AndReturn("<response><msg><id>msg_id</id>" +
+            "<status>2</status></msg></response>")
+        self.mox.ReplayAll()
+
+        self.assertRaises(MstrReportException, self.report.submit, max_cols=10)
+
+    def test_execute_many_closed(self):
+        """ Test closing the generator drops the jobs not started yet.
+        """
+
+        executed = []
+        def request(arguments):
+            executed.append(arguments['reportID'])
+            time.sleep(0.05)
+            return self.report_response
+        self.client._request = request
+
+        results = self.client.execute_many([dict(report_id='id%s' % i,
+            max_cols=10) for i in range(10)], max_workers=1)
+        results.next()
+        results.close()
+        self.assertTrue(len(executed) <= 3)
+
+    def test_execute_many(self):
+        """ Test jobs are run in order of priority, that connection errors
+            and retriable error statuses are retried, and that failed jobs do
+            not stop the others.
+        """
+
+        import copy
+        deadlines = []
+        def record_deadline(*args):
+            deadlines.append(self.client._local.deadline)
+        first = copy.deepcopy(self.report_args)
+        first['reportID'] = 'first_id'
+        second = copy.deepcopy(self.report_args)
+        second['reportID'] = 'second_id'
+        self.client._request(first).WithSideEffects(record_deadline).AndRaise(
+            requests.exceptions.ConnectionError('connection reset'))
+        self.client._request(first).AndRaise(MstrRequestException(
+            'unavailable', 503, retriable=True))
+        self.client._request(first).AndReturn(self.report_response)
+        self.client._request(second).AndReturn("<response><report_data_list>" +
+            "<report_data><error>Report is invalid</error></report_data>" +
+            "</report_data_list></response>")
+        self.mox.ReplayAll()
+
+        jobs = [dict(report_id='second_id', priority=2, max_cols=10),
+            dict(report_id='first_id', priority=1, max_cols=10)]
+        start = time.time()
+        results = list(self.client.execute_many(jobs, max_workers=1,
+            per_job_timeout=30, retries=2))
+
+        self.assertEqual(['first_id', 'second_id'],
+            [r.job['report_id'] for r in results])
+        self.assertEqual(3, results[0].attempts)
+        self.assertEqual(None, results[0].error)
+        self.assertEqual(2, len(results[0].result))
+        self.assertEqual(1, results[1].attempts)
+        self.assertEqual(None, results[1].result)
+        self.assertTrue(isinstance(results[1].error, MstrReportException))
+        self.assertTrue(abs(deadlines[0] - start - 30) < 5)
+
+    def test_cached_execute(self):
+        """ Test executing a report again with the same arguments reuses the
+            rows from the result cache, including for a new Report object.
+        """
+
+        self.client._request(self.report_args).AndReturn(self.report_response)
+        self.mox.ReplayAll()
+
+        self.client._result_cache = MemoryCache()
+        self.report.execute(max_cols=10)
+        self.report.execute(max_cols=10)
+        report = Report(self.client, 'report_id')
+        report.execute(max_cols=10)
+
+        self.assertEqual(self.report.get_values(), report.get_values())
+        self.assertEqual(self.report.get_headers(), report.get_headers())
+        self.assertEqual(2, self.client._result_cache.hits)
+
+    def test_stream_execute(self):
+        """ Test rows are yielded one by one when streaming a report, that
+            the headers are recorded on the report and that the parsing is
+            reported once the rows have all been read.
+        """
+
+        self.client._request(self.report_args, stream=True).AndReturn(
+            io.BytesIO(self.report_response))
+        self.mox.ReplayAll()
+        parsed = []
+        self.client._parsed = lambda rows, seconds: parsed.append(rows)
+        set_headers = self.report._set_headers
+        recorded = []
+        def record(headers):
+            recorded.append(headers)
+            set_headers(headers)
+        self.report._set_headers = record
+
+        rows = self.report.execute(max_cols=10, stream=True)
+        attr1 = Attribute('header1_id', 'header1_name')
+        attr2 = Attribute('header2_id', 'header2_name')
+        self.assertEqual([(attr1, 'col1_val1'), (attr2, 'col2_val1')],
+            rows.next())
+        self.assertEqual([attr1, attr2], self.report.get_headers())
+        self.assertEqual([attr1, attr2], self.report.get_attributes())
+        self.assertEqual([(attr1, 'col1_val2'), (attr2, 'col2_val2')],
+            rows.next())
+        self.assertEqual([], parsed)
+        self.assertRaises(StopIteration, rows.next)
+        self.assertEqual([2], parsed)
+        self.assertEqual(1, len(recorded))
+        self.assertEqual(None, self.report._values)
+
+    def test_to_columns(self):
+        """ Test a report is parsed into typed, dictionary encoded columns.
+        """
+
+        response = "<response><objects><attribute rfd='0' id='a_id' " +\
+            "name='a_name'/><metric rfd='1' id='m_id' name='m_name'/>" +\
+            "</objects><raw_data><headers><oi rfd='0'/><oi rfd='1'/>" +\
+            "</headers><rows><r><v>x</v><v>1.5</v></r><r><v>y</v><v/></r>" +\
+            "<r><v>x</v><v>3</v></r><r><v/><v>4</v></r><r><v>y</v>" +\
+            "<v>1,234.5</v></r></rows></raw_data></response>"
+        self.client._request(self.report_args, stream=True).AndReturn(
+            io.BytesIO(response))
+        self.mox.ReplayAll()
+
+        columns = self.report.to_columns(max_cols=10)
+
+        attr = Attribute('a_id', 'a_name')
+        metric = Metric('m_id', 'm_name')
+        self.assertEqual([attr, metric], columns.headers)
+        self.assertEqual([attr, metric], self.report.get_headers())
+        self.assertEqual(5, len(columns))
+        self.assertEqual(['x', 'y'], columns[0].categories)
+        self.assertEqual([0, 1, 0, -1, 1], list(columns[0].codes))
+        self.assertEqual(['x', 'y', 'x', None, 'y'], [columns[0][i]
+            for i in range(5)])
+        self.assertEqual('d', columns[1].values.typecode)
+        self.assertEqual(1.5, columns[1][0])
+        self.assertTrue(columns[1][1] != columns[1][1])
+        self.assertEqual([3.0, 4.0], list(columns[1].values[2:4]))
+        self.assertTrue(columns[1][4] != columns[1][4])
+        self.assertEqual({4: '1,234.5'}, columns[1].invalid)
+
+    def test_to_columns_parse_pool(self):
+        """ Test responses are parsed by the parse pool of the client and
+            that the columns and errors come back from its process.
+        """
+
+        response = "<response><objects><attribute rfd='0' id='a_id' " +\
+            "name='a_name'/><metric rfd='1' id='m_id' name='m_name'/>" +\
+            "</objects><raw_data><headers><oi rfd='0'/><oi rfd='1'/>" +\
+            "</headers><rows><r><v>x</v><v>1.5</v></r><r><v/><v/></r>" +\
+            "<r><v>y</v><v>3</v></r></rows></raw_data></response>"
+        self.client._request(self.report_args, stream=True).AndReturn(
+            io.BytesIO(response))
+        self.client._request(self.report_args, stream=True).AndReturn(
+            io.BytesIO("<response><error>failed</error></response>"))
+        self.mox.ReplayAll()
+
+        pool = self.client._parse_pool = multiprocessing.Pool(1)
+        try:
+            columns = self.report.to_columns(max_cols=10)
+            self.assertRaises(MstrReportException, self.report.to_columns,
+                max_cols=10)
+        finally:
+            pool.terminate()
+
+        attr = Attribute('a_id', 'a_name')
+        self.assertTrue(columns.headers[0] is attr)
+        self.assertEqual(Metric('m_id', 'm_name'), columns.headers[1])
+        self.assertEqual(['x', None, 'y'], [columns[0][i] for i in range(3)])
+        self.assertEqual(['x', 'y'], columns[0].categories)
+        columns[0].append('y')
+        self.assertEqual(1, columns[0].codes[-1])
+        self.assertEqual(1.5, columns[1][0])
+        self.assertTrue(columns[1][1] != columns[1][1])
+        self.assertEqual(3.0, columns[1][2])
+
+    def test_typed_execute(self):
+        """ Test values are converted according to the metric or the base
+            form type of the attribute of their column.
+        """
+
+        response = "<response><objects><attribute rfd='0' id='d_id' " +\
+            "name='d_name'><form base_form_type='8'/></attribute>" +\
+            "<attribute rfd='1' id='t_id' name='t_name'><form " +\
+            "base_form_type='3'/></attribute><metric rfd='2' id='m_id' " +\
+            "name='m_name'/></objects><raw_data><headers><oi rfd='0'/>" +\
+            "<oi rfd='1'/><oi rfd='2'/></headers><rows><r><v>1/31/2014</v>" +\
+            "<v>x</v><v>1.5</v></r><r><v/><v/><v/></r><r><v>1/31/2014</v>" +\
+            "<v>0012</v><v>3</v></r></rows></raw_data></response>"
+        self.client._request(self.report_args).AndReturn(response)
+        self.mox.ReplayAll()
+
+        import datetime
+        result = self.report.execute(max_cols=10, typed=True)
+
+        self.assertEqual(('date', 'text', 'number'), result.types)
+        self.assertEqual([[datetime.date(2014, 1, 31), None,
+            datetime.date(2014, 1, 31)], ['x', None, '0012'], [1.5, None, 3.0]],
+            result.get_columns())
+        self.assertEqual(result.get_values(), self.report.get_values())
+
+    def test_convert_column(self):
+        """ Test the conversion of each column type, keeping the values
+            which cannot be converted.
+        """
+
+        import datetime
+        from decimal import Decimal
+        self.assertEqual([1.5, None, None, 'abc'],
+            convert_column(['1.5', '', None, 'abc'], 'number'))
+        self.assertEqual([Decimal('1.10')], convert_column(['1.10'], 'decimal'))
+        self.assertEqual([datetime.datetime(2014, 1, 31, 13, 2, 3)],
+            convert_column(['1/31/2014 1:02:03 PM'], 'datetime'))
+        self.assertEqual([datetime.date(2014, 2, 1), 'soon'],
+            convert_column(['2014-02-01', 'soon'], 'date'))
+        self.assertEqual([datetime.time(13, 1, 2)],
+            convert_column(['13:01:02'], 'time'))
+
+    def test_export_csv(self):
+        """ Test a report is written to a csv file page by page, without
+            storing the rows on the report.
+        """
+
+        import copy
+        for start, values in [(0, ['a', 'b']), (2, ['c'])]:
+            args = copy.deepcopy(self.report_args)
+            args.update({'startRow': start, 'maxRows': 2})
+            self.client._request(args).AndReturn(self._page_response(values))
+        self.mox.ReplayAll()
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            rows = self.report.export(path, chunk_rows=2, max_cols=10)
+            with open(path) as f:
+                content = f.read()
+        finally:
+            os.remove(path)
+
+        self.assertEqual(3, rows)
+        self.assertEqual("header1_name,header2_name\r\na,a\r\nb,b\r\nc,c\r\n",
+            content)
+        self.assertEqual(2, len(self.report.get_headers()))
+        self.assertEqual(None, self.report._values)
+
+    def test_typed_values_invalid(self):
+        """ Test values which cannot be converted to the type of their
+            column become None, and text columns are left as they are.
+        """
+
+        typed_values = py_mstr.py_mstr._ArrowWriter._typed_values
+        self.assertEqual([1.5, None, None], typed_values(['1.5', '1,234.5',
+            None], 'number', 'm_name'))
+        self.assertEqual([datetime.date(2014, 1, 2), None], typed_values(
+            ['2014-01-02', 'n/a'], 'date', 'a_name'))
+        self.assertEqual(['1,234.5', None], typed_values(['1,234.5', None],
+            'text', 'a_name'))
+
+    def test_export_arrow_invalid_values(self):
+        """ Test values which cannot be converted to the type of their
+            column are exported as nulls.
+        """
+
+        if py_mstr.py_mstr.pyarrow is None:
+            # pyarrow is not installed
+            return
+        response = "<response><objects><metric rfd='0' id='m_id' " +\
+            "name='m_name'/></objects><raw_data><headers><oi rfd='0'/>" +\
+            "</headers><rows><r><v>1.5</v></r><r><v>1,234.5</v></r>" +\
+            "<r><v/></r></rows></raw_data></response>"
+        self.client._request(mox.IgnoreArg()).AndReturn(response)
+        self.mox.ReplayAll()
+
+        pyarrow = py_mstr.py_mstr.pyarrow
+        handle, path = tempfile.mkstemp(suffix='.arrow')
+        os.close(handle)
+        try:
+            self.report.export(path, format='arrow', chunk_rows=10,
+                max_cols=10)
+            reader = pyarrow.RecordBatchFileReader(pyarrow.memory_map(path))
+            values = reader.read_all().column(0).to_pylist()
+        finally:
+            os.remove(path)
+
+        self.assertEqual([1.5, None, None], values)
+
+    def test_export_unsupported_format(self):
+        self.assertRaises(MstrReportException, self.report.export, 'out.xls',
+            format='xls')
+
+    def _page_response(self, values):
+        rows = ''.join(["<r><v>%s</v><v>%s</v></r>" % (v, v) for v in values])
+        return self.report_response[:self.report_response.index('<r fr')] + \
+            rows + "</rows></raw_data></report_data></report_data_list>" + \
+            "</response>"
+
+    def test_paged_execute(self):
+        """ Test pages are requested until a short page is returned and that
+            the rows are stored in order. The last batch of concurrent
+            requests may run past the end of the report.
+        """
+
+        import copy
+        for start, values in [(0, ['a', 'b']), (2, ['c', 'd']), (4, ['e', 'f']),
+                (6, ['g']), (8, [])]:
+            args = copy.deepcopy(self.report_args)
+            args.update({'startRow': start, 'maxRows': 2})
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._page_response(values))
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        self.report.execute_paged(page_size=2, concurrency=2, max_cols=10)
+
+        values = self.report.get_values()
+        self.assertEqual(7, len(values))
+        self.assertEqual(['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+            [row[0][1] for row in values])
+        self.assertEqual(2, len(self.report.get_headers()))
+
+    def test_paged_execute_total_rows(self):
+        """ Test no pages past the known total row count are requested.
+        """
+
+        import copy
+        for start, values in [(0, ['a', 'b']), (2, ['c', 'd'])]:
+            args = copy.deepcopy(self.report_args)
+            args.update({'startRow': start, 'maxRows': 2})
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._page_response(values))
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        self.report.execute_paged(page_size=2, concurrency=3, max_cols=10,
+            total_rows=4)
+        self.assertEqual(4, len(self.report.get_values()))
+
+    def test_partitioned_execute(self):
+        """ Test an element prompt is answered in partitions, executed
+            concurrently, and that their rows are merged in order.
+        """
+
+        import copy
+        prompt = Prompt('p1guid', 'Prompt 1', False,
+            Attribute('attr1_id', 'attr1_name'))
+        other = Prompt('p2guid', 'Prompt 2', False,
+            Attribute('attr2_id', 'attr2_name'))
+        for answers, values in [('a;b', ['a', 'b']), ('c;d', ['c']),
+                ('e', ['e'])]:
+            args = copy.deepcopy(self.report_args)
+            args['elementsPromptAnswers'] = 'attr1_id;' + ';'.join(
+                ['attr1_id:' + v for v in answers.split(';')]) + \
+                ',attr2_id;attr2_id:x'
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._page_response(values))
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        result = self.report.execute_partitioned(prompt,
+            ['a', 'b', 'c', 'd', 'e'], partition_size=2, max_cols=10,
+            element_prompt_answers={other: ['x']})
+
+        self.assertEqual(['a', 'b', 'c', 'e'], [row[0][1] for row in result])
+        self.assertEqual(2, len(result.get_headers()))
+        self.assertEqual(4, len(self.report.get_values()))
+
+    def test_partitioned_execute_headers(self):
+        """ Test partitions returning different headers raise an error.
+        """
+
+        prompt = Prompt('p1guid', 'Prompt 1', False,
+            Attribute('attr1_id', 'attr1_name'))
+        other = "<response><objects><metric rfd='0' id='m' name='m'/>" + \
+            "</objects><raw_data><headers><oi rfd='0'/></headers><rows>" + \
+            "<r><v>1</v></r></rows></raw_data></response>"
+        self.client._request(mox.IgnoreArg()).InAnyOrder().AndReturn(
+            self._page_response(['a']))
+        self.client._request(mox.IgnoreArg()).InAnyOrder().AndReturn(other)
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        self.assertRaises(MstrReportException, self.report.execute_partitioned,
+            prompt, ['a', 'b'], partition_size=1, max_cols=10)
+
+    def test_paged_execute_server_total_rows(self):
+        """ Test the row count returned with the first page bounds the pages
+            requested.
+        """
+
+        import copy
+        for start, values in [(0, ['a', 'b']), (2, ['c', 'd']), (4, ['e'])]:
+            args = copy.deepcopy(self.report_args)
+            args.update({'startRow': start, 'maxRows': 2})
+            self.client._request(args).InAnyOrder().AndReturn(
+                self._page_response(values).replace("cn='100000'", "cn='5'"))
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        result = self.report.execute_paged(page_size=2, concurrency=4,
+            max_cols=10)
+        self.assertEqual(5, len(result))
+        self.assertEqual(5, result.total_rows)
+
+    def test_stream_error_execute(self):
+        """ Test that an error returned by MicroStrategy is raised while
+            streaming the rows.
+        """
+
+        source = io.BytesIO("<taskResponse><report_data_list><report_data>" +
+            "<error>Object executed is in prompt status.</error>" +
+            "</report_data></report_data_list></taskResponse>")
+        self.client._request(self.report_args, stream=True).AndReturn(source)
+        self.mox.ReplayAll()
+
+        self.assertRaises(MstrReportException, list,
+            self.report.iter_rows(max_cols=10))
+        self.assertTrue(source.closed)
+
+    def test_stream_closed_early(self):
+        """ Test the response is closed when the rows are not all consumed.
+        """
+
+        source = io.BytesIO(self.report_response)
+        self.client._request(self.report_args, stream=True).AndReturn(source)
+        self.mox.ReplayAll()
+
+        rows = self.report.iter_rows(max_cols=10)
+        rows.next()
+        self.assertFalse(source.closed)
+        rows.close()
+        self.assertTrue(source.closed)
+
     def test_element_prompt_execute(self):
         """ Test element prompt answers are configured correctly before
             executing the report. Prompt answers do not impact the format of
@@ -378,6 +1485,259 @@ class MstrReportTestCase(mox.MoxTestBase):
         self.report.execute(element_prompt_answers={prompt1: ['value']},
             value_prompt_answers=[(prompt2, 'value2'), (prompt3, '')])
 
+class AsyncMstrClientTestCase(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        s = stubout.StubOutForTesting()
+        s.Set(MstrClient, '_login', lambda self, source, name, username,
+            password: None)
+        self.client = MstrClient('url?', 'username', 'pw', 'source', 'name')
+        self.client._session = 'session'
+        self.mox.StubOutWithMock(self.client, "_request")
+        self.async_client = AsyncMstrClient(self.client, concurrency=2)
+
+    def tearDown(self):
+        self.async_client.close()
+        mox.MoxTestBase.tearDown(self)
+
+    def test_get_attribute(self):
+        """ Test a task runs in the background and its result is returned by
+            the AsyncResult.
+        """
+
+        args = {
+            'taskId': 'getAttributeForms',
+            'attributeID': 'attr_id',
+            'sessionState': 'session'
+        }
+        self.client._request(args).AndReturn("<response><root><container>" +
+            "<dssid>attr_id</dssid><n>attr_name</n></container></root>" +
+            "</response>")
+
+        self.mox.ReplayAll()
+
+        attr = self.async_client.get_attribute('attr_id').get(5)
+        self.assertEqual('attr_id', attr.guid)
+        self.assertEqual('attr_name', attr.name)
+
+    def test_execute(self):
+        """ Test concurrent executions of a report each return their own
+            ReportResult.
+        """
+
+        report_response = "<response><objects><metric rfd='0' id='m_id' " +\
+            "name='m_name'/></objects><raw_data><headers><oi rfd='0'/>" +\
+            "</headers><rows><r><v>%s</v></r></rows></raw_data></response>"
+        for start_row in (0, 1):
+            self.client._request(mox.ContainsKeyValue('startRow', start_row)
+                ).InAnyOrder().AndReturn(report_response % start_row)
+
+        self.mox.ReplayAll()
+        serialize_calls(self.client, '_request')
+
+        report = self.async_client.get_report('report_id')
+        first = report.execute(start_row=0)
+        second = report.execute(start_row=1)
+        metric = Metric('m_id', 'm_name')
+        self.assertEqual(ReportResult, type(first.get(5)))
+        self.assertEqual([[(metric, '0')]], first.get(5).get_values())
+        self.assertEqual([[(metric, '1')]], second.get(5).get_values())
+
+    def test_get_prompts_message_kept(self):
+        """ Test the msgID retrieved by get_prompts is kept on the report
+            for its next prompted execution.
+        """
+
+        self.client._request(mox.ContainsKeyValue('taskId', 'reportExecute')
+            ).AndReturn("<response><msg><id>msg_id</id></msg></response>")
+        self.client._request(mox.ContainsKeyValue('taskId', 'getPrompts')
+            ).AndReturn("<response><rsl><prompts/></rsl></response>")
+        self.mox.ReplayAll()
+
+        report = self.async_client.get_report('report_id')
+        self.assertEqual([], report.get_prompts().get(5))
+        self.assertEqual(('msg_id', 'session'), report._report._message)
+
+class MstrSessionPoolTestCase(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.logins = []
+        def login(client, source, name, username, password):
+            self.logins.append((source, name, username))
+            return 'session%s' % len(self.logins)
+        self.stubs.Set(MstrClient, '_login', login)
+        self.pool = MstrSessionPool(max_size=2)
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+
+    def _client(self):
+        return MstrClient('url?', 'username', 'pw', 'source', 'name',
+            session_pool=self.pool)
+
+    def test_sessions_are_reused(self):
+        """ Test a session released by a client is handed to the next client
+            without logging in again.
+        """
+
+        client = self._client()
+        self.assertEqual('session1', client._session)
+        del client
+        client = self._client()
+        self.assertEqual('session1', client._session)
+        self.assertEqual([('source', 'name', 'username')], self.logins)
+
+    def test_sessions_in_use_are_not_shared(self):
+        client1 = self._client()
+        client2 = self._client()
+        self.assertEqual('session1', client1._session)
+        self.assertEqual('session2', client2._session)
+
+    def test_expired_session_is_replaced(self):
+        """ Test an idle session the server no longer accepts is replaced by
+            a new login.
+        """
+
+        self.pool = MstrSessionPool(max_idle=-1)
+        self.stubs.Set(MstrClient, '_session_alive',
+            lambda client, session: False)
+        client = self._client()
+        del client
+        client = self._client()
+        self.assertEqual('session2', client._session)
+
+    def test_rejected_session_is_replaced(self):
+        """ Test an idle session whose check fails because it has expired
+            is replaced, without trying to renew the session of the client
+            being created.
+        """
+
+        def send(client, arguments, task_id, stream):
+            raise MstrRequestException('expired', 500, '-2147468986',
+                session_expired=True)
+        self.pool = MstrSessionPool(max_idle=-1)
+        client = self._client()
+        del client
+        self.stubs.Set(MstrClient, '_send', send)
+        client = self._client()
+        self.assertEqual('session2', client._session)
+        self.stubs.UnsetAll()
+
+    def test_close_logs_out(self):
+        client = self._client()
+        del client
+        self.mox.StubOutWithMock(requests, 'get')
+        requests.get(mox.And(mox.StrContains('taskId=logout'),
+            mox.StrContains('sessionState=session1')), timeout=10)
+        self.mox.ReplayAll()
+
+        self.pool.close()
+
+    def test_released_after_close_logs_out(self):
+        """ Test a session in use when the pool is closed is logged out by
+            its client instead of going back to the pool.
+        """
+
+        logouts = []
+        self.stubs.Set(MstrClient, '_logout',
+            lambda client: logouts.append(client._session))
+        client = self._client()
+        self.pool.close()
+        del client
+        self.assertEqual(['session1'], logouts)
+        self.assertEqual({}, self.pool._idle)
+
+class MemoryCacheTestCase(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MemoryCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_expired_entries_are_missed(self):
+        cache = MemoryCache(ttl=60)
+        cache.set('a', 1, ttl=-1)
+        cache.set('b', 2)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
+        self.assertEqual(1, len(cache))
+
+    def test_invalidate_prefix(self):
+        cache = MemoryCache()
+        cache.set('x|a', 1)
+        cache.set('x|b', 2)
+        cache.set('y|a', 3)
+        cache.invalidate('x|')
+        self.assertEqual(None, cache.get('x|a'))
+        self.assertEqual(3, cache.get('y|a'))
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+
+
+class SqliteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_entries_are_shared(self):
+        """ Test entries written through one cache object are read through
+            another one using the same file.
+        """
+
+        cache = SqliteCache(self.path)
+        cache.set('x|a', [{'id': 'id 1'}])
+        cache.set('x|b', ('guid', 'name'), ttl=-1)
+        other = SqliteCache(self.path)
+        self.assertEqual([{'id': 'id 1'}], other.get('x|a'))
+        self.assertEqual(None, other.get('x|b'))
+        other.invalidate('x|')
+        self.assertEqual(None, cache.get('x|a'))
+        self.assertEqual(1, other.hits)
+        self.assertEqual(1, other.misses)
+        self.assertEqual(1, cache.misses)
+
+    def test_size_limits(self):
+        """ Test expired entries are purged and the entries closest to
+            expiry are evicted once a limit is exceeded.
+        """
+
+        cache = SqliteCache(self.path, max_size=2)
+        cache.set('a', 1, ttl=-1)
+        cache.set('b', 2, ttl=60)
+        cache.set('c', 3, ttl=120)
+        self.assertEqual(2, len(cache))
+        cache.set('d', 4, ttl=180)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+        value = 'x' * 100
+        cache = SqliteCache(self.path, max_bytes=250)
+        cache.invalidate()
+        cache.set('a', value, ttl=60)
+        cache.set('b', value, ttl=120)
+        cache.set('c', value, ttl=180)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(value, cache.get('b'))
+        cache.set('d', 'x' * 300)
+        self.assertEqual(None, cache.get('d'))
+        self.assertEqual(2, len(cache))
+
+
 class SingletonTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -410,6 +1770,33 @@ class SingletonTestCase(unittest.TestCase):
         s2 = Metric('guid1', 'value2')
         self.assertNotEqual(s1, s2)
 
+    def test_unused_objects_are_dropped(self):
+        s1 = Metric('unused_guid', 'value1')
+        self.assertTrue('unused_guid' in Metric._instances)
+        del s1
+        gc.collect()
+        self.assertFalse('unused_guid' in Metric._instances)
+
+    def test_objects_have_no_dict(self):
+        self.assertFalse(hasattr(Attribute('guid1', 'value1'), '__dict__'))
+        self.assertFalse(hasattr(Metric('guid1', 'value1'), '__dict__'))
+        self.assertFalse(hasattr(Prompt('guid1', 'P1', False), '__dict__'))
+
+    def test_concurrent_creation(self):
+        """ Test threads creating objects with the same guid at the same time
+            all get the same object.
+        """
+
+        results = []
+        def create():
+            results.append(Attribute('concurrent_guid', 'value1'))
+        threads = [threading.Thread(target=create) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set([id(s) for s in results])))
+
 class PromptTestCase(unittest.TestCase):
 
     def setUp(self):